@@ -1,56 +1,290 @@
 import pygame
 from pygame.locals import *
 from pygame.color import *
-import pymunk as pm
-from pymunk import Vec2d
+import engine
+import frames
+import replay
+from profiler import Profiler
+try:
+    from entitystore import EntityStore
+except ImportError:
+    # No NumPy, entities are drawn one by one
+    EntityStore = None
+import os
 import sys
+import argparse
+import cProfile
+import pstats
 import random
 import math
-import datetime
+import io
+import threading
+import time
+from collections import OrderedDict
 
 def to_pygame(p):
     """Small hack to convert pymunk to pygame coordinates"""
     return int(p[0]), int(-p[1]+600)
 
-class Ball:
+class Assets:
+    """
+    Central registry for the game's images and fonts.
+    Every file is only read from disk once, either up front through
+    preload(), on a background thread through load_in_background() or on
+    first use, and images are converted to the display's pixel format as
+    soon as there is a display to convert to. The images drawn rotated
+    have every rotation made as they are loaded, once they are converted
+    """
+
+    IMAGES = ("crate.png", "tnt_crate.png", "broken_crate1.png",
+              "broken_crate2.png", "snake.png", "dead_snake.png",
+              "trebuchet.png", "machinarium_floor.jpg", "greyed_out.jpg")
+    FONTS = ("cartwheel.otf",)
+    ROTATED = ("crate.png", "tnt_crate.png", "broken_crate1.png",
+               "broken_crate2.png", "snake.png", "dead_snake.png")
+
+    def __init__(self, rotation_steps=360):
+        """
+        Initialise the Assets
+        """
+        self.rotation_steps = rotation_steps
+        self.images = {}
+        self.rotations = {}
+        self.fonts = {}
+        self.converted = set()
+        self.stats = OrderedDict() # filename -> (seconds, bytes)
+        self.loading = {}          # filename -> Event set once it's loaded
+        self.loader = None
+
+    def image(self, filename):
+        """
+        Returns the shared surface for an image, loading it if needed.
+        An image still being loaded in the background is waited for
+        """
+        loading = self.loading.get(filename)
+        if loading is not None:
+            loading.wait()
+        img = self.images.get(filename)
+        if img is None:
+            started = time.perf_counter()
+            img = pygame.image.load(filename)
+            self.images[filename] = img
+            img = self.convert_image(filename)
+            self.record(filename, started, img)
+        elif filename not in self.converted:
+            img = self.convert_image(filename)
+        return img
+
+    def rotated(self, filename, angle):
+        """
+        Returns the image rotated by angle (in radians, as pymunk gives it).
+        Angles are rounded to one of rotation_steps steps and each step is
+        only rotated once, then shared by every sprite using the image
+        """
+        steps = self.rotation_steps
+        step = int(round(math.degrees(angle) * steps / 360.0)) % steps
+        return self.rotation(filename, step)
+
+    def rotation(self, filename, step):
+        """
+        Returns the image rotated by a number of rotation steps
+        """
+        # The background loader can be filling the table in at the same
+        # time, setdefault makes sure both use the same one
+        table = self.rotations.get(filename)
+        if table is None:
+            table = self.rotations.setdefault(filename,
+                                              [None] * self.rotation_steps)
+        img = table[step]
+        if img is None:
+            img = pygame.transform.rotozoom(self.image(filename),
+                                step * 360.0 / self.rotation_steps, 1)
+            table[step] = img
+        return img
+
+    def prerotate(self, filename):
+        """
+        Builds every rotation step of an image up front. Rotations are
+        thrown away when an image is converted, so this is only worth
+        doing once it has been
+        """
+        for step in range(self.rotation_steps):
+            self.rotated(filename, math.radians(step * 360.0 /
+                                                self.rotation_steps))
+
+    def font(self, filename):
+        """
+        Returns a file object for a font, so pygame can build a
+        pygame.font.Font from it without going back to the disk
+        """
+        data = self.fonts.get(filename)
+        if data is None:
+            started = time.perf_counter()
+            with open(filename, "rb") as font_file:
+                data = font_file.read()
+            self.fonts[filename] = data
+            self.stats[filename] = (time.perf_counter() - started, len(data))
+        return io.BytesIO(data)
+
+    def convert_image(self, filename):
+        """
+        Converts a loaded image to the display's pixel format, keeping
+        per pixel alpha for PNGs. Does nothing until a display is set up
+        """
+        img = self.images[filename]
+        if filename in self.converted or pygame.display.get_surface() is None:
+            return img
+        if filename.endswith(".png"):
+            img = img.convert_alpha()
+        else:
+            img = img.convert()
+        self.images[filename] = img
+        self.rotations.pop(filename, None)
+        self.converted.add(filename)
+        return img
+
+    def convert(self):
+        """
+        Converts every image loaded before the display was set up
+        """
+        for filename in list(self.images):
+            self.convert_image(filename)
+
+    def preload(self):
+        """
+        Loads every image and font the game uses
+        """
+        for filename in self.IMAGES:
+            self.image(filename)
+        for filename in self.ROTATED:
+            if filename in self.converted:
+                self.prerotate(filename)
+        for filename in self.FONTS:
+            self.font(filename)
+
+    def load_in_background(self, filenames=None):
+        """
+        Starts loading images, every image the game uses by default, on a
+        background thread in the given order. Decoding them is most of the
+        game's startup time and doesn't need the main thread, which only
+        converts them to the display's format as they are first used
+        """
+        filenames = [filename for filename in (filenames or self.IMAGES)
+                     if filename not in self.images and
+                     filename not in self.loading]
+        for filename in filenames:
+            self.loading[filename] = threading.Event()
+        self.loader = threading.Thread(target=self.load_images,
+                                       args=(filenames,), daemon=True)
+        self.loader.start()
+
+    def load_images(self, filenames):
+        """
+        Loads images, run by the background loader. They are converted if
+        there is a display to convert to, then once every image has loaded
+        the rotations of those drawn rotated are made. An image that fails
+        to load is left for image() to load again, and raise the error,
+        when it is first used
+        """
+        for filename in filenames:
+            try:
+                started = time.perf_counter()
+                img = pygame.image.load(filename)
+                self.images[filename] = img
+                self.record(filename, started, img)
+                self.convert_image(filename)
+            except (pygame.error, OSError):
+                pass
+            finally:
+                self.loading.pop(filename).set()
+        for filename in self.ROTATED:
+            if filename in filenames and filename in self.converted:
+                self.prerotate(filename)
+
+    def wait(self):
+        """
+        Waits for the background loader to finish, if there is one
+        """
+        if self.loader is not None:
+            self.loader.join()
+            self.loader = None
+
+    def record(self, filename, started, img):
+        """
+        Records how long an image took to load and how much memory it uses
+        """
+        width, height = img.get_size()
+        self.stats[filename] = (time.perf_counter() - started,
+                                width * height * img.get_bytesize())
+
+    def report(self):
+        """
+        Returns a line per loaded asset with its load time and memory use
+        """
+        lines = []
+        for filename, (seconds, size) in self.stats.items():
+            lines.append("{0:<24} {1:8.2f} ms {2:8.1f} KiB"
+                         .format(filename, seconds * 1000, size / 1024.0))
+        return lines
+
+assets = Assets()
+
+def rotated_sprite(filename, entity, rotated=None, alpha=1.0):
+    """
+    Returns an image rotated to an entity's angle and the rect centring it
+    on its body, alpha of the way between the previous physics step and
+    the current one. A sleeping body doesn't move, so the surface it was
+    last drawn with can be passed back in as rotated to skip the rotation
+    lookup
+    """
+    position, angle = entity.interpolated(alpha)
+    if rotated is None or not entity.shape.body.is_sleeping:
+        rotated = assets.rotated(filename, angle)
+    return rotated, rotated.get_rect(center=to_pygame(position))
+
+class Ball(engine.Ball):
     """
     Provides a ball for the player to fire from the trebuchet
     """
 
-    def __init__(self, space, x, y):
+    def __init__(self, space, x, y, kind=0):
         """
         Sets up pygame and pymunk properties for the Ball
         """
-        #mass = 3
-        mass = 5
-        radius = 20
-        inertia = pm.moment_for_circle(mass, 0, radius, (0,0))
-        body = pm.Body(mass, inertia)
-        body.position = (x,y)
-        shape = pm.Circle(body, radius, (0,0))
-        shape.friction = 15.0
-        shape.elasticity = 0.9
-        space.add(body, shape)
-        self.ball = shape
+        super().__init__(space, x, y, kind)
         self.colour = THECOLORS["red"]
 
-    def draw(self):
+    # Ball surfaces, one per colour and radius
+    surfaces = {}
+    drawn = None
+
+    def sprite(self, alpha=1.0):
         """
-        Draws the ball to the screen
+        Returns the ball's surface and the rect to draw it at, alpha of
+        the way between the previous physics step and the current one
         """
-        global screen
-
-        ball = self.ball
-        r = ball.radius
-        p = to_pygame(ball.body.position)
-        pygame.draw.circle(screen, self.colour, p, int(r), 20)
+        r = int(self.ball.radius)
+        key = (tuple(self.colour), r)
+        surface = Ball.surfaces.get(key)
+        if surface is None:
+            surface = pygame.Surface((r * 2, r * 2), SRCALPHA)
+            pygame.draw.circle(surface, self.colour, (r, r), r, 20)
+            Ball.surfaces[key] = surface
+        p = to_pygame(self.interpolated(alpha)[0])
+        return surface, surface.get_rect(center=p)
+
+    def draw(self, target, alpha=1.0):
+        """
+        Draws the ball to a target surface, returns the rect drawn to
+        """
+        return target.blit(*self.sprite(alpha))
 
-    def random_colour(self):
+    def random_colour(self, rng=random):
         """
-        Picks the balls colour at random
+        Picks the balls colour at random, with rng
         """
 
-        rand = random.randint(0,3)
+        rand = rng.randint(0,3)
 
         if rand == 0:
             self.colour = THECOLORS["blue"]
@@ -60,173 +294,315 @@ class Ball:
             self.colour = THECOLORS["orange"]
         elif rand == 3:
             self.colour = THECOLORS["brown"]
+        self.drawn = None
 
-    def fire(self, force):
-        """
-        Applys an impulse to the ball object
-        """
-        pm.Body.apply_impulse(self.ball.body, (force,0))
-
-    def get_position(self):
-        """
-        Returns the Ball's coordinates
-        """
-        return self.ball.body.position
-
-    def reposition(self, x, y):
+    def state(self):
         """
-        Allows user to move the ball to a specified location
+        Returns the ball's state, for a Snapshot
         """
-        self.ball.body.position = (x,y)
+        state = super().state()
+        state["colour"] = self.colour
+        return state
 
-    def delete(self, space):
+    def restore(self, state):
         """
-        Removes occurences of the Crate object from pymunk's space
+        Puts the ball back in a state returned by state()
         """
-        space.remove(self.ball)
-        space.remove(self.ball.body)
+        super().restore(state)
+        self.colour = state["colour"]
+        self.drawn = None
 
-
-class Crate:
+class Crate(engine.Crate):
     """
     Provides a crate object for building structure in the game_complete
     Can be a small crate or larger TNT crate by supplying an optional
     paramter to the contructor
     """
 
+    # The GameWorld's EntityStore and row in it, if it has one
+    store = None
+    row = None
+
     def __init__(self, space, starting_position, is_tnt=False, mass=6.0):
         """
-        Sets up pygame and pymunk properties for the Ball
+        Sets up pygame and pymunk properties for the Crate
         Decides whether a normal or TNT crate was requested
         """
-        self.is_tnt = is_tnt
-        if is_tnt:
-            points = [(-46, -46), (-46, 46), (46,46), (46, -46)]
-            self.crate_img = pygame.image.load("tnt_crate.png")
-        else:
-            points = [(-23, -23), (-23, 23), (23,23), (23, -23)]
-            self.crate_img = pygame.image.load("crate.png")
+        super().__init__(space, starting_position, is_tnt, mass)
+        self.set_image()
 
-        moment = pm.moment_for_poly(int(mass), points, (0,0))
-        body = pm.Body(mass, moment)
-        body.position = starting_position
-        shape = pm.Poly(body, points, (0,0))
-        shape.friction = 1
-        space.add(body,shape)
-        self.crate = shape
-        self.run_count = 0
+    def set_image(self):
+        """
+        Picks the crate's image from its type and whether it is broken
+        """
+        if self.broken:
+            self.crate_file = "broken_crate{0}.png".format(self.broken)
+        elif self.is_tnt:
+            self.crate_file = "tnt_crate.png"
+        else:
+            self.crate_file = "crate.png"
+        self.crate_img = assets.image(self.crate_file)
+        self.rotated = None
+        self.drawn = None
+        if self.store is not None:
+            self.store.set_sprite(self.row, self.crate_file)
+            self.store.show(self.row, not self.exploded)
+
+    def reset(self, starting_position):
+        """
+        Puts the Crate back to how it was built at a new position
+        """
+        super().reset(starting_position)
+        self.set_image()
 
-    def brake_crate(self):
+    def brake_crate(self, rng=random):
         """
         Changes the crates image to a 'broken' style crate,
         Only for use with smaller crates
-        """        
-        self.run_count += 1
-        if self.run_count == 1:
-            num = random.randint(1,2)
-
-            if not self.is_tnt:
-                self.crate_img = \
-                        pygame.image.load("broken_crate{0}.png".format(num))
+        """
+        super().brake_crate(rng)
+        if self.broken:
+            self.set_image()
 
-    def draw(self):
+    def explode(self, space):
         """
-        Draws the crate to the screen, depending on it's type
+        Takes an exploded TNT crate out of the space, and out of sight
         """
-        global screen
+        super().explode(space)
+        self.set_image()
 
-        crate = self.crate
-        if self.is_tnt:
-            crate_img = pygame.transform.rotozoom(self.crate_img, \
-                                            math.degrees(crate.body.angle), 1)
-            box_x = crate.body.position[0] - crate_img.get_size()[1] + 46
-            box_y = crate.body.position[1] + crate_img.get_size()[1] - 46
-        else:            
-            crate_img = pygame.transform.rotozoom(self.crate_img, \
-                                            math.degrees(crate.body.angle), 1)
-            box_x = crate.body.position[0] - 23
-            box_y = crate.body.position[1] + 23
+    def restore(self, state):
+        """
+        Puts the crate back in a state returned by state(), only picking
+        its image again if it has broken or gone off since
+        """
+        look = (self.broken, self.exploded)
+        super().restore(state)
+        if (self.broken, self.exploded) != look:
+            self.set_image()
+        else:
+            self.rotated = None
+            self.drawn = None
 
-        crate_rect = crate_img.get_rect()
-        crate_rect = crate_rect.move(to_pygame((box_x, box_y)))
-        screen.blit(crate_img,crate_rect)
+    def sprite(self, alpha=1.0):
+        """
+        Returns the crate's surface, depending on it's type, and the rect
+        to draw it at
+        """
+        self.rotated, rect = rotated_sprite(self.crate_file, self,
+                                            self.rotated, alpha)
+        return self.rotated, rect
 
-    def delete(self, space):
+    def draw(self, target, alpha=1.0):
         """
-        Removes occurences of the Crate object from pymunk's space
+        Draws the crate to a target surface, returns the rect drawn to
         """
-        space.remove(self.crate)
-        space.remove(self.crate.body)
+        return target.blit(*self.sprite(alpha))
 
-class Snake:
+class Snake(engine.Snake):
     """
     Provides a Snake character as the player's enemy
     """
 
-    snakes_alive = 0 # Static
-    already_killed_snake = False
-    
+    # The GameWorld's EntityStore and row in it, if it has one
+    store = None
+    row = None
+
     def __init__(self, space, starting_position, mass=1.0):
         """
         Sets up pygame and pymunk properties for the Snake
         """
-        points = [(-40, -40), (-40, 40), (40,40), (40, -40)]
-        moment = pm.moment_for_poly(int(mass), points, (0,0))
-        body = pm.Body(mass, moment)
-        body.position = starting_position
-        shape = pm.Poly(body, points, (0,0))
-        shape.friction = 1
-        space.add(body,shape)
-        self.snake = shape
-        self.snake_img = pygame.image.load("snake.png")
-        Snake.snakes_alive += 1        
+        super().__init__(space, starting_position, mass)
+        self.set_image()
 
-    def draw(self):
+    def set_image(self):
         """
-        Draws the Snake to the screen
+        Picks the snake's image from whether it is dead
         """
+        if self.already_killed_snake:
+            self.snake_file = "dead_snake.png"
+        else:
+            self.snake_file = "snake.png"
+        self.snake_img = assets.image(self.snake_file)
+        self.rotated = None
+        self.drawn = None
+        if self.store is not None:
+            self.store.set_sprite(self.row, self.snake_file)
+
+    def reset(self, starting_position):
+        """
+        Puts the Snake back to how it was built at a new position
+        """
+        super().reset(starting_position)
+        self.set_image()
 
-        global screen
-        
-        snake_img = pygame.transform.rotozoom(self.snake_img, \
-                                math.degrees(self.snake.body.angle), 1)
-        snake_x = self.snake.body.position[0] - 36
-        snake_y = self.snake.body.position[1] + 36
-
-        snake_rect = snake_img.get_rect()
-        snake_rect = snake_rect.move(to_pygame((snake_x, snake_y)))
-        screen.blit(snake_img,snake_rect)
+    def sprite(self, alpha=1.0):
+        """
+        Returns the Snake's surface and the rect to draw it at
+        """
+        self.rotated, rect = rotated_sprite(self.snake_file, self,
+                                            self.rotated, alpha)
+        return self.rotated, rect
 
-    def is_dead(self):
+    def draw(self, target, alpha=1.0):
         """
-        Returns whether the snake is dead, by checking if it is near
-        the toxic puddle
+        Draws the Snake to a target surface, returns the rect drawn to
         """
-        return self.snake.body.position[1] < 110 + self.snake_img.get_size()[0]
+        return target.blit(*self.sprite(alpha))
 
     def kill_snake(self):
         """
         Changes Snakes image to a dead one
         """
         if not self.already_killed_snake:
-            Snake.snakes_alive -= 1
-            self.snake_img = pygame.image.load("dead_snake.png")
-            self.already_killed_snake = True
+            super().kill_snake()
+            self.set_image()
+
+    def restore(self, state):
+        """
+        Puts the snake back in a state returned by state(), only picking
+        its image again if it has died since
+        """
+        dead = self.already_killed_snake
+        super().restore(state)
+        if self.already_killed_snake != dead:
+            self.set_image()
+        else:
+            self.rotated = None
+            self.drawn = None
+
+class Ramp(engine.Ramp):
+    """
+    Provides the ramp the ball is launched from, its end follows the mouse
+    """
+
+    # The ramp's end, surface and rect when it was last drawn
+    drawn = None
+
+    def sprite(self):
+        """
+        Returns a surface with the ramp drawn on it and the rect to draw
+        it at. The surface is only drawn again when the ramp moves
+        """
+        start, end = to_pygame(self.start), to_pygame(self.end)
+        if self.drawn is None or self.drawn[0] != end:
+            left, top = min(start[0], end[0]), min(start[1], end[1])
+            rect = pygame.Rect(left, top, abs(end[0] - start[0]) + 2,
+                               abs(end[1] - start[1]) + 2)
+            # Transparent red, so the line's smoothed edges blend in
+            surface = pygame.Surface(rect.size, SRCALPHA)
+            surface.fill(THECOLORS['red'][:3] + (0,))
+            pygame.draw.aaline(surface, THECOLORS['red'],
+                               (start[0] - left, start[1] - top),
+                               (end[0] - left, end[1] - top))
+            self.drawn = (end, surface, rect)
+        return self.drawn[1:]
+
+    def draw(self, target):
+        """
+        Draws the ramp to a target surface, returns the rect drawn to
+        """
+        return target.blit(*self.sprite())
+
+class GameWorld(engine.World):
+    """
+    The engine's World, with entities that can draw themselves.
+    With NumPy the crates and snakes are kept in an EntityStore and drawn
+    from its arrays
+    """
+
+    ball_class  = Ball
+    crate_class = Crate
+    snake_class = Snake
+    ramp_class  = Ramp
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initialise the GameWorld, the arguments are the World's
+        """
+        self.store = EntityStore(assets) if EntityStore else None
+        super().__init__(*args, **kwargs)
+
+    def load(self, data, seed=0):
+        """
+        Sets up a level as the World does, then fills the store
+        """
+        super().load(data, seed)
+        if self.store is not None:
+            for crate in self.crates:
+                self.store.add(crate, crate.crate_file)
+            for snake in self.snakes:
+                self.store.add(snake, snake.snake_file)
+            self.store.reset_previous()
+
+    def clear(self):
+        """
+        Removes the level as the World does, emptying the store
+        """
+        super().clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def restore(self, snapshot):
+        """
+        Puts the level back as the World does, then reads it into the
+        store
+        """
+        super().restore(snapshot)
+        if self.store is not None:
+            self.store.reset_previous()
+
+    def reset_ball(self, kind=0):
+        """
+        Puts a fresh ball of a kind and a random colour in the ball area,
+        returns it
+        """
+        ball = super().reset_ball(kind)
+        ball.random_colour(self.random)
+        return ball
 
-    def delete(self, space):
+    def interpolated_entities(self):
         """
-        Removes occurences of the Snake object from pymunk's space
+        Returns the entities whose previous positions step() keeps, the
+        store keeps its own for the crates and snakes
         """
-        space.remove(self.snake)
-        space.remove(self.snake.body)
+        if self.store is not None:
+            return self.balls
+        return super().interpolated_entities()
 
-    # Static
-    def all_snakes_dead():
+    def step(self, dt=engine.STEP):
+        """
+        Steps the World, then reads the bodies into the store
         """
-        Static Class method,
-        Returns whether all snakes are dead or not
+        if self.store is not None and self.interpolate:
+            self.store.store_previous()
+        killed = super().step(dt)
+        if self.store is not None:
+            self.store.read()
+        return killed
+
+    def sprites(self, alpha, view):
         """
-        return Snake.snakes_alive == 0
+        Returns (entity, surface, rect) for the balls, crates and snakes
+        whose centres are in view, a pygame rect. Entities out of view
+        aren't rotated or positioned at all, and a sleeping body doesn't
+        move, so the sprite it was last drawn with is reused
+        """
+        sprites = []
+        crates = [crate for crate in self.crates if not crate.exploded]
+        entities = self.balls + crates + self.snakes
+        if self.store is not None:
+            entities = self.balls
+        for entity in entities:
+            body = entity.shape.body
+            if not view.collidepoint(to_pygame(body.position)):
+                continue
+            if entity.drawn is None or not body.is_sleeping:
+                entity.drawn = entity.sprite(alpha)
+            sprites.append((entity,) + entity.drawn)
+        if self.store is not None:
+            sprites += self.store.sprites(alpha, view)
+        return sprites
 
 class Image:
     """
@@ -237,23 +613,37 @@ class Image:
         """
         Initialise the Image
         """
-        self.img = pygame.image.load(filename)
+        self.filename = filename
         self.rect = self.img.get_rect()
         if starting_position:
             self.move(starting_position)
 
+    @property
+    def img(self):
+        """
+        The image's surface, shared through the asset registry
+        """
+        return assets.image(self.filename)
+
     def move(self, position):
         """
         Reposition the image
         """
         self.rect = self.rect.move(position)
 
-    def display(self):
+    def display(self, target):
+        """
+        Draws the image to a target surface
+        """
+        return target.blit(self.img, self.rect)
+
+    def submit(self, renderer, layer=None):
         """
-        Draws the image to the screen
+        Submits the image to a Renderer, on the background layer unless
+        another is given
         """
-        global screen
-        screen.blit(self.img, self.rect)
+        renderer.sprite(("image", self.filename), self.img, self.rect,
+                        BACKGROUND_LAYER if layer is None else layer)
 
     def get_size(self):
         """
@@ -261,82 +651,370 @@ class Image:
         """
         return self.img.get_size()
 
+class TextCache:
+    """
+    Caches fonts per size and rendered text surfaces, so that text which
+    is displayed every frame is only rendered again when it changes.
+    Rendered surfaces are kept in least recently used order and the oldest
+    are dropped once they take up more than max_bytes
+    """
+
+    def __init__(self, font_file='cartwheel.otf', max_bytes=4*1024*1024):
+        """
+        Initialise the TextCache
+        """
+        self.font_file = font_file
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+
+    def font(self, size):
+        """
+        Returns the font for the given size, only loading it once
+        """
+        font = self.fonts.get(size)
+        if font is None:
+            font = pygame.font.Font(assets.font(self.font_file), size)
+            self.fonts[size] = font
+        return font
+
+    def render(self, message, size, colour, shadow=False):
+        """
+        Returns a surface with the message rendered on it, with a shadow
+        drawn 3 pixels below and to the right if requested
+        """
+        key = (message, size, tuple(colour), shadow)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+
+        text = self.font(size).render(message, 1, colour)
+        if shadow:
+            shadow_text = self.font(size).render(message, 1, (10,10,10))
+            width, height = text.get_size()
+            surface = pygame.Surface((width + 3, height + 3), SRCALPHA)
+            surface.blit(shadow_text, (3, 3))
+            surface.blit(text, (0, 0))
+        else:
+            surface = text
+
+        self.surfaces[key] = surface
+        self.used_bytes += self.surface_bytes(surface)
+        while self.used_bytes > self.max_bytes and len(self.surfaces) > 1:
+            old_key, old_surface = self.surfaces.popitem(last=False)
+            self.used_bytes -= self.surface_bytes(old_surface)
+        return surface
+
+    def surface_bytes(self, surface):
+        """
+        Returns the memory used by a surface's pixels
+        """
+        width, height = surface.get_size()
+        return width * height * surface.get_bytesize()
+
+    def clear(self):
+        """
+        Drops every cached font and surface
+        """
+        self.fonts.clear()
+        self.surfaces.clear()
+        self.used_bytes = 0
+
+text_cache = TextCache()
+
 class Message:
     """
     Abstracts pygame's font object, for easier use.
-    Intended to be used annonymously
+    Intended to be used annonymously, the rendered text comes from
+    text_cache so building the same Message every frame is cheap
     """
     
     def __init__(self, message, position, size=50, colour=(255,255,255)):
         """
         Initialise the Message
         """
-        self.font = pygame.font.Font('cartwheel.otf', size)
-        self.text = self.font.render(message, 1, colour)
         self.position = position
         self.message = message
         self.size = size
+        self.colour = colour
 
-    def display(self):
+    def sprite(self, shadow=False):
         """
-        Prints the Message to the screen
+        Returns the rendered Message, with a shadow effect if asked for,
+        and the rect to draw it at
         """
-        global screen
-        screen.blit(self.text,self.position)
+        text = text_cache.render(self.message, self.size, self.colour,
+                                 shadow)
+        return text, text.get_rect(topleft=self.position)
 
-    def display_shadow(self):
+    def display(self, target):
         """
-        Prints the Message to the screen with a shadow effect
+        Prints the Message to a target surface
         """
-        global screen
-        shadow_font = pygame.font.Font('cartwheel.otf', self.size)
-        shadow_text = shadow_font.render(self.message, 1, (10,10,10))
-        screen.blit(shadow_text, (self.position[0] + 3, self.position[1] + 3))
-        screen.blit(self.text,self.position)
+        return target.blit(*self.sprite())
 
-def main():
-    
-    # Setup Level common variables -------------------------------- ##
+    def display_shadow(self, target):
+        """
+        Prints the Message to a target surface with a shadow effect
+        """
+        return target.blit(*self.sprite(True))
+
+    def submit(self, renderer, shadow=True):
+        """
+        Submits the Message to a Renderer's HUD layer, with a shadow effect
+        unless shadow is false. A Message at the same position replaces it
+        next frame
+        """
+        renderer.sprite(("message", self.position), *self.sprite(shadow),
+                        layer=HUD_LAYER)
+
+# Layers of sprites, each drawn over the ones before it
+BACKGROUND_LAYER = 0   # whole screen images, over the scenery
+WORLD_LAYER      = 1   # the balls, crates, snakes, ramp and preview
+HUD_LAYER        = 2   # text
+LAYERS           = 3
+
+class Renderer:
+    """
+    Draws frames to a target surface by only redrawing what changed.
+    The static scenery is composed once into a background surface. Each
+    frame sprites are submitted as (surface, rect) on a layer, drawn in
+    the order they were submitted within it. Only the areas of sprites that
+    moved are restored from the background, redrawn and, when the target
+    is the display, pushed to it. Any other surface can be the target, for
+    drawing frames offscreen
+    """
+
+    def __init__(self, target):
+        """
+        Initialise the Renderer
+        """
+        self.target = target
+        self.background = None
+        self.layers = [[] for layer in range(LAYERS)]
+        self.drawn = {}       # key -> (surface, rect) drawn last frame
+        self.full_redraw = True
+        self.updated = []     # rects of the target the last frame changed
+        self.frame_time = 0.0    # seconds between the last two frames
+        self.render_time = 0.0   # seconds spent drawing the last frame
+        self.pixels_pushed = 0   # pixels changed by the last frame
+        self.blits = 0           # surfaces blitted last frame
+        self.last_frame = None
+
+    def set_background(self, surface):
+        """
+        Sets the surface of static scenery drawn behind everything
+        """
+        self.background = surface
+        self.invalidate()
 
-    force    = 2300 # Force upon the ball when it is fired
-    rampsize = 100  # end coordinate of the ball's ramp
+    def invalidate(self):
+        """
+        Makes the next frame redraw the whole target, for when something
+        else has drawn over it
+        """
+        self.full_redraw = True
 
-    pygame.init()    
+    def sprite(self, key, surface, rect, layer=WORLD_LAYER):
+        """
+        Submits a sprite on a layer for this frame, key identifies it
+        between frames
+        """
+        self.layers[layer].append((key, surface, rect))
+
+    def end_frame(self):
+        """
+        Draws the submitted sprites, layer by layer, and pushes the changed
+        parts of the target to the display if it is the display
+        """
+        started = time.perf_counter()
+        target = self.target
+        background = self.background
+        target_rect = target.get_rect()
+        sprites = [sprite for layer in self.layers for sprite in layer]
+        full_redraw = self.full_redraw
+
+        if full_redraw:
+            # One blits call per layer
+            with frame_profiler.section("blit"):
+                target.blit(background, (0, 0))
+                for layer in self.layers:
+                    target.blits([(surface, rect)
+                                  for key, surface, rect in layer], False)
+                self.blits = len(sprites) + 1
+            updates = [target_rect]
+            self.full_redraw = False
+        else:
+            # Areas that need restoring: where moved sprites were and are
+            dirty = []
+            current = set()
+            for key, surface, rect in sprites:
+                current.add(key)
+                old = self.drawn.get(key)
+                if old is None or old[0] is not surface or old[1] != rect:
+                    dirty.append(rect)
+                    if old is not None:
+                        dirty.append(old[1])
+            for key, (surface, rect) in self.drawn.items():
+                if key not in current:
+                    dirty.append(rect)
+
+            # Each area is restored then has the sprites over it redrawn
+            # in layer order, clipped so sprites outside it aren't drawn
+            # over
+            with frame_profiler.section("blit"):
+                self.blits = 0
+                rects = [rect for key, surface, rect in sprites]
+                for area in dirty:
+                    target.set_clip(area)
+                    target.blit(background, area, area)
+                    over = area.collidelistall(rects)
+                    target.blits([(sprites[i][1], rects[i]) for i in over],
+                                 False)
+                    self.blits += 1 + len(over)
+                target.set_clip(None)
+            updates = [rect.clip(target_rect) for rect in dirty]
+
+        if target is pygame.display.get_surface():
+            with frame_profiler.section("display"):
+                if full_redraw:
+                    pygame.display.flip()
+                else:
+                    pygame.display.update(updates)
+        self.updated = updates
+        self.pixels_pushed = sum(rect.width * rect.height
+                                 for rect in updates)
+
+        frame_profiler.count("blits", self.blits)
+        frame_profiler.count("pixels", self.pixels_pushed)
+        self.drawn = dict((key, (surface, rect))
+                          for key, surface, rect in sprites)
+        for layer in self.layers:
+            del layer[:]
+
+        finished = time.perf_counter()
+        self.render_time = finished - started
+        if self.last_frame is not None:
+            self.frame_time = finished - self.last_frame
+        self.last_frame = finished
+
+# Section timings for the game loop, disabled unless asked for
+frame_profiler = Profiler()
+
+def submit_profile_overlay(renderer):
+    """
+    Submits the frame profiler's percentiles and counts, in the top left
+    """
+    for i, line in enumerate(frame_profiler.report()):
+        Message(line, (10, 40 + i * 18), 16).submit(renderer)
+
+# How far past the screen edges a body's centre can be while part of its
+# sprite still shows, half a rotated TNT crate's diagonal
+VIEW_MARGIN = 70
+
+# Every PREVIEW_DOTS ticks of the predicted path gets a dot
+PREVIEW_DOTS = 2
+_preview_dot = None
+
+def preview_sprites(path):
+    """
+    Returns (key, surface, rect) for the dots showing a predicted path.
+    They are drawn as sprites, so only the dots that moved are redrawn
+    """
+    global _preview_dot
+    if _preview_dot is None:
+        _preview_dot = pygame.Surface((6, 6), SRCALPHA)
+        pygame.draw.circle(_preview_dot, THECOLORS["white"], (3, 3), 3)
+    return [(("preview", i), _preview_dot,
+             _preview_dot.get_rect(center=to_pygame(point)))
+            for i, point in enumerate(path[PREVIEW_DOTS::PREVIEW_DOTS])]
+
+# Longest frame the physics will catch up on, so a long stall doesn't
+# leave it stepping forever
+MAX_FRAME_TIME = 0.25
+
+# The window is the size of the floor image
+SCREEN_SIZE = (1024, 652)
+
+def setup_screen(first=()):
+    """
+    Opens the window and returns a Renderer for it, without any scenery
+    yet. Only the parts of pygame the game uses are initialised, and the
+    images are loaded on a background thread, those in first ahead of the
+    rest, so the first frame can be shown before they have all loaded
+    """
+    pygame.display.init()
+    pygame.font.init()
     pygame.display.set_caption("Angry Clones")
-    clock = pygame.time.Clock()    
 
-    # Set up static images, these never move
-    greyed_out = Image("greyed_out.jpg")
+    screen = pygame.display.set_mode(SCREEN_SIZE)
+    assets.convert()
+    assets.load_in_background(list(first) + [filename for filename in
+                                             Assets.IMAGES
+                                             if filename not in first])
+    return Renderer(screen)
+
+def setup_offscreen():
+    """
+    Returns a Renderer drawing to a surface in memory instead of a window,
+    for exporting frames. pygame only converts images to a display's pixel
+    format, so without a display already set up the dummy video driver is
+    given a one pixel display for that, which is never drawn to
+    """
+    if pygame.display.get_surface() is None:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        pygame.display.init()
+        pygame.display.set_mode((1, 1))
+    pygame.font.init()
+    assets.convert()
+    return Renderer(pygame.Surface(SCREEN_SIZE))
+
+def show_scenery(renderer):
+    """
+    Gives the renderer the scenery as its background, it never moves so is
+    drawn once: the floor, the trebuchet and the ball area
+    """
     background = Image("machinarium_floor.jpg")
     trebuchet  = Image("trebuchet.png", (20,450))
 
-    global screen
-    screen = pygame.display.set_mode(background.get_size())
-    
-    space = pm.Space()
-    space.gravity = (0.0, -300.0)
-    body = pm.Body()
-
-    # ground
-    ground = pm.Segment(body, (0,100), (1050, 100), .0)
-    ground.friction = 6.0
-    space.add(ground)
+    scenery = background.img.copy()
+    scenery.blit(trebuchet.img, trebuchet.rect)
+    pygame.draw.aaline(scenery, THECOLORS['red'],\
+                        to_pygame((0,110)), to_pygame((60,110)))
+    renderer.set_background(scenery)
 
-     #left wall
-    left_wall = pm.Segment(body, to_pygame((0,0)), to_pygame((0, 2000)), .0)
-    left_wall.friction = 6.0
-    space.add(left_wall)
+# Seconds the still screens show for, unless space skips them. Screens
+# between levels show one message for a moment, then another
+TITLE_TIME    = 70 / 60.0
+MESSAGE_TIME  = 0.5
+SCREEN_TIME   = 70 / 60.0
+GOOD_TRY_TIME = 1.0
 
-    # ball area
-    ball_area = pm.Segment(body, (0,110), (60,110), .0)
-    space.add(ball_area)
+class Input:
+    """
+    Reads the events for every scene. Quitting or ESC ends the game from
+    any of them and F3 shows or hides the profiler overlay, other key
+    presses go to the scene's key(). Scenes that draw every frame poll,
+    still ones block waiting for an event, so they use no CPU between them
+    """
 
-    
-    # Title Screen ------------------------------------------------- ##
+    def __init__(self, renderer, overlay=False):
+        """
+        Initialise the Input. The mouse is only read for its position and
+        buttons, so moving it doesn't need to wake a waiting scene
+        """
+        self.renderer = renderer
+        self.overlay = overlay
+        frame_profiler.enabled = overlay or frame_profiler.record
+        pygame.event.set_blocked(MOUSEMOTION)
 
-    count = 0
-    while count < 70:
-        for event in pygame.event.get():
+    def dispatch(self, scene, events):
+        """
+        Handles events for a scene
+        """
+        for event in events:
             if event.type == QUIT:
                 pygame.quit()
                 sys.exit(0)
@@ -344,369 +1022,739 @@ def main():
                 if event.key == K_ESCAPE:
                     pygame.quit()
                     sys.exit(0)
-                # Space bar skips the title screen
-                if event.key == 32:
-                    count = 71
-
-        greyed_out.display()
-        
-        Message("Angry Clones!", (220,250), 95).display_shadow()
-
-        pygame.display.flip()
-        count += 1
-
-    # End Title Screen ---------------------------------------------- ##
-
-    # Main Game loop ------------------------------------------------ ##
-
-    game_complete = False
-    level = 0
-    while not game_complete:
-
-        # Record time now, to see how fast you complete the game
-        start_game_timer = datetime.datetime.now()
-
-        trying_again = True
-        while trying_again:
-
-            # Level setup ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
-
-            if level == 0:
-                balls = []    
-                x,y = (2,110)
-                balls.append(Ball(space, x, y))
-
-                # Add crates
-                crates = []
-                crates += [Crate(space, (500,85+(23+i*51))) for i in range(3)]
-                crates += [Crate(space, (600,85+(23+i*51))) for i in range(3)]
-                crates += [Crate(space, (505+46,278), True)]
-
-                # Add one snake
-                snakes = []
-                snakes.append(Snake(space, to_pygame((551,232))))
-
-                level_complete = False
-                level_failed = False
-                count = 0
-
-            if level == 1:
-                
-                # Remove all old crates etc from the playing area
-                for crate in crates:
-                    crate.delete(space)
-                for ball in balls:
-                    ball.delete(space)
-                for snake in snakes:
-                    snake.delete(space)
-
-                balls = []    
-                x,y = (2,110)
-                balls.append(Ball(space, x, y))
-
-                # Map of intended level     -   Key
-                #------------------------------------------------
-                #                #T#            S = Snake
-                #             S  ###  S       
-                #            #T# #T# #T#      #T# = TNT crate
-                #            ### ### ###      ###
-                #           #   #   #   #
-                #           #   #   #   #
-                #           #   #   #   #
-                #           A B C D E F G
-
-
-                # Add crates
-                crates = []
-                crates += [Crate(space, (500,85+(23+i*51))) for i in range(3)]#A
-                crates += [Crate(space, (600,85+(23+i*51))) for i in range(3)]#C
-                crates += [Crate(space, (700,85+(23+i*51))) for i in range(3)]#E
-                crates += [Crate(space, (800,85+(23+i*51))) for i in range(3)]#G
-                crates += [Crate(space, (505+46,278), True)] #B
-                crates += [Crate(space, (605+46,278), True)] #D
-                crates += [Crate(space, (705+46,278), True)] #F
-                crates += [Crate(space, (605+46,378), True)] #D higher
-
-                # Add snakes
-                Snake.snakes_alive = 0
-                snakes = []
-                snakes.append(Snake(space, (551,350)))
-                snakes.append(Snake(space, (751,350)))
-
-                level_complete = False
-                level_failed = False
-                count = 0
-                start_timer = datetime.datetime.now()
-
-            if level == 2:
-                
-                # Remove all old crates etc from the playing area
-                for crate in crates:
-                    crate.delete(space)
-                for ball in balls:
-                    ball.delete(space)
-                for snake in snakes:
-                    snake.delete(space)
-
-                balls = []    
-                x,y = (2,110)
-                balls.append(Ball(space, x, y))
-
-                # Map of intended level     - Key
-                #------------------------------------------------
-                #              S          S = Snake
-                #             #T#       
-                #          S  ###       #T# = TNT crate
-                #         #T# #T#       ###
-                #      S  ### ### 
-                #     #T# #T# #T#    
-                #     ### ### ###
-                #      A   B   C     
-
-                # Add crates
-                crates = []
-                crates += [Crate(space, (305+46,170), True)] #A
-                crates += [Crate(space, (505+46,170), True)] #B
-                crates += [Crate(space, (505+46,270), True)] #
-                crates += [Crate(space, (705+46,170), True)] #C
-                crates += [Crate(space, (705+46,270), True)] #
-                crates += [Crate(space, (705+46,370), True)] #
-
-                # Add snakes
-                Snake.snakes_alive = 0
-                snakes = []
-                snakes.append(Snake(space, (351,310)))
-                snakes.append(Snake(space, (551,410)))
-                snakes.append(Snake(space, (751,510)))
-
-                level_complete = False
-                level_failed = False
-                count = 0
-                start_timer = datetime.datetime.now()
-
-            # End Level Setup ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
-
-            # Game-play loop ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
-            
-            while not level_complete and not level_failed:
-
-                space.step(1/30.0)
-                clock.tick(30)
-                    
-                for event in pygame.event.get():
-                    if event.type == QUIT:
-                        pygame.quit()
-                        sys.exit(0)
-                    elif event.type == KEYDOWN:
-                        if event.key == K_ESCAPE:
-                            pygame.quit()
-                            sys.exit(0)
-                        # Spacebar is pressed
-                        if event.key == 32: # Reset the ball if lost
-                            balls[0].delete(space)
-                            balls = []    
-                            x,y = (2,110)
-                            balls.append(Ball(space, x, y))
-                            balls[0].random_colour()
-
-                #Get ramp slope from mouse 'y'
-                rampsize = to_pygame(pygame.mouse.get_pos())[1]
-                slope = pm.Segment(body, (60,110), (250,rampsize), .0)
-                space.add(slope)
-
-                background.display()
-                trebuchet.display()  
-                balls[0].draw()          
-
-                if pygame.mouse.get_pressed()[0]:
-                    balls[0].fire(force/3)
-
-                for crate in crates:
-                    crate.draw()
-
-                # Add variety to crate's looks
-                if level == 0:
-                    crates[1].brake_crate()
-                    crates[5].brake_crate()
-                    crates[0].brake_crate()
-
-                if level == 1:                    
-                    crates[3].brake_crate()
-                    crates[8].brake_crate()
-                    crates[1].brake_crate()
-                    crates[5].brake_crate()
-
-                for snake in snakes:
-                    snake.draw()
-                    if snake.is_dead():
-                        snake.kill_snake() #This doesn't make sense!
-                        Message("The Snake is Dead!", \
-                                                (600,600)).display_shadow()
-                    
-                    #If you kill all the snakes you win the level
-                    if Snake.all_snakes_dead():
-                        level_complete = True
-                        level_failed = False
-                        pass
-
-                #Draw Ramp
-                pygame.draw.aaline(screen, THECOLORS['red'], \
-                                to_pygame((60,110)), to_pygame((250,rampsize)))
-                #Draw Ball Area
-                pygame.draw.aaline(screen, THECOLORS['red'],\
-                                to_pygame((0,110)), to_pygame((60,110)))
-
-                #If mouse goes of screen to the right, bring it back
-                if to_pygame(balls[0].get_position())[0] > 1024:
-                    balls[0].reposition(1,110)
-
-                #Display number of snakes left
-                Message("{0}".format("Snakes Left: {0}"\
-                        .format(Snake.snakes_alive)),(0,0), 30).display_shadow()
-
-                #Time attack for levels 2 and 3
-                if level > 0:
-                    #Work out time remaining
-                    delta = datetime.datetime.now() - start_timer
-                    Message("{0}".format("Time Left: {0}"\
-                                    .format(30 - delta.seconds)),(830,0),30)\
-                                                            .display_shadow()
-
-                    #If time has passed, you fail the level
-                    if 30 - delta.seconds <= 0:
-                        level_failed = True
-
-                pygame.display.flip()
-                count += 1
-                #del slope
-
-            # End Game-play Loop ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
-
-            # You have either completed the level or failed it
-
-            # FAILED: Ask if you would like to try again --------------- ##
-            
-            if level_failed:
-                count = 0
-                while count < 70:
-                    space.step(1/30.0)
-                    clock.tick(30)
-
-                    for event in pygame.event.get():
-                        if event.type == QUIT:
-                            pygame.quit()
-                            sys.exit(0)
-                        elif event.type == KEYDOWN:
-                            if event.key == K_ESCAPE:
-                                pygame.quit()
-                                sys.exit(0)
-                            # Spacebar is pressed
-                            if event.key == 32:
-                                trying_again = True
-                                # End the loop and start next level
-                                count = 71
-
-                    greyed_out.display()
-                    
-                    if count < 30:
-                        Message("Good Try!", (320,250), 95).display_shadow()
-
-                    if count > 30:
-                        Message("Press SPACE to try again", (80,250), 80)\
-                                                            .display_shadow()
-                        Message("Press ESC to quit", (300,400), 60)\
-                                                            .display_shadow()
+                elif event.key == K_F3:
+                    self.overlay = not self.overlay
+                    frame_profiler.enabled = (self.overlay or
+                                              frame_profiler.record)
+                    self.renderer.invalidate()
+                else:
+                    scene.key(event.key)
+            elif event.type == VIDEOEXPOSE:
+                # Something drew over the window
+                self.renderer.invalidate()
+                scene.changed = True
 
-                    pygame.display.flip()
-                    count += 1
-
-                    # Trick to halt the game on message
-                    if count == 32:
-                        count = 31
-
-            # End Try again screen ------------------------------------ ##
-
-            # You didn't fail, show next level screen ----------------- ##
-
-            if level_complete:
-                count = 0
-                while count < 70:
-
-                    for event in pygame.event.get():
-                        if event.type == QUIT:
-                            pygame.quit()
-                            sys.exit(0)
-                        elif event.type == KEYDOWN:
-                            if event.key == K_ESCAPE:
-                                pygame.quit()
-                                sys.exit(0)
-                            if event.key == 32:
-                                want_to_try_again = True
-                                count = 71
-
-                    greyed_out.display()
-                    
-                    # No need if you are on the last level,
-                    # Just go to final conratulations screen
-                    if level < 2:
-                        # Display this message first
-                        if count < 30:
-                            Message("Well Done", (320,250), 95).display_shadow()
-
-                        # Then this
-                        if count > 30:
-                            next_lvl = level + 2
-                            Message("Level {0}".format(next_lvl),\
-                                                 (350,250), 95).display_shadow()
-                    else:
-                        count = 71
+    def poll(self, scene):
+        """
+        Handles the events waiting, without blocking
+        """
+        self.dispatch(scene, pygame.event.get())
 
-                    pygame.display.flip()
-                    count += 1
-                if level == 2:
-                    game_complete = True
-                    trying_again = False
-                else:
-                    level += 1
+    def wait(self, scene, timeout=None):
+        """
+        Blocks until there is an event or timeout seconds have passed,
+        forever if timeout is None, then handles the events waiting
+        """
+        if timeout is None:
+            event = pygame.event.wait()
+        else:
+            # A timeout of 0 would wait forever
+            event = pygame.event.wait(max(int(timeout * 1000), 1))
+        self.dispatch(scene, [event] + pygame.event.get())
+
+class Scene:
+    """
+    A state of the game: the title, playing a level or a screen between
+    levels. Each turn of the game loop hands it the events then calls
+    update(), which returns the scene to run next, itself to carry on
+    """
 
-        # End next level screen -------------------------------------- ##
-       
-        # Completed the game 
-        # (can only try again or quit so must have won to get here)
+    def __init__(self, game):
+        """
+        Initialise the Scene
+        """
+        self.game = game
+        self.changed = True
 
-        end_time = datetime.datetime.now()
-        time_taken =  end_time - start_game_timer
+    def enter(self):
+        """
+        Called when the scene starts running
+        """
+        self.changed = True
 
-        count = 0
-        while count < 70:
+    def timeout(self):
+        """
+        Returns the seconds the game loop can wait for an event before
+        update() is needed again, 0 to only poll or None to wait for one
+        """
+        return None
 
-            for event in pygame.event.get():
-                if event.type == QUIT:
-                    pygame.quit()
-                    sys.exit(0)
-                elif event.type == KEYDOWN:
-                    if event.key == K_ESCAPE:
-                        pygame.quit()
-                        sys.exit(0)
-                    if event.key == 32:
-                        want_to_try_again = True
-                        count = 71
-
-            greyed_out.display()
-            
-            # Display this message first
-            if count < 30:
-                Message("Game Completed!", (130,250), 95).display_shadow()
-
-            # Then this
-            if count > 30:
-                Message("You completed the game", (190,250), 65)\
-                                                            .display_shadow()
-                Message("In: {0} seconds".format(time_taken.seconds),\
-                                                (230,350), 95).display_shadow()
-
-            pygame.display.flip()
-            count += 1
+    def key(self, key):
+        """
+        Handles a key press
+        """
+
+    def update(self):
+        """
+        Draws the scene if it needs to and returns the scene to run next
+        """
+        return self
+
+class Screen(Scene):
+    """
+    A still screen of messages over the greyed out scenery, which only
+    draws when it changes. It goes through phases of (seconds, messages),
+    each shown until seconds after the screen started, the last can be
+    None to stay until space is pressed. Space skips the screen at any
+    time. following() returns the scene after it
+    """
+
+    def __init__(self, game, phases, following):
+        """
+        Initialise the Screen
+        """
+        super().__init__(game)
+        self.phases = phases
+        self.following = following
+        self.phase = 0
+        self.started = None
+        self.skipped = False
+
+    def enter(self):
+        """
+        Starts the screen from its first phase
+        """
+        super().enter()
+        self.phase = 0
+        self.started = time.perf_counter()
+        self.skipped = False
+
+    def ends(self):
+        """
+        Returns the seconds after the start the current phase ends at
+        """
+        return self.phases[self.phase][0]
+
+    def timeout(self):
+        """
+        Returns the seconds until the current phase ends
+        """
+        if self.ends() is None:
+            return None
+        return max(self.ends() - (time.perf_counter() - self.started), 0)
+
+    def key(self, key):
+        """
+        Space skips the screen
+        """
+        if key == K_SPACE:
+            self.skipped = True
+
+    def update(self):
+        """
+        Moves on to the phase due, drawing it, or to the following scene
+        """
+        if self.skipped:
+            return self.following()
+        elapsed = time.perf_counter() - self.started
+        while self.ends() is not None and elapsed >= self.ends():
+            self.phase += 1
+            if self.phase == len(self.phases):
+                return self.following()
+            self.changed = True
+        if self.changed:
+            self.draw()
+            self.changed = False
+        return self
+
+    def draw(self):
+        """
+        Draws the current phase's messages
+        """
+        renderer = self.game.renderer
+        Image("greyed_out.jpg").submit(renderer)
+        for message in self.phases[self.phase][1]:
+            message.submit(renderer)
+        renderer.end_frame()
+
+class Title(Screen):
+    """
+    The title screen. It has a background of its own, as it is drawn
+    while the scenery's images are still loading
+    """
+
+    def __init__(self, game):
+        """
+        Initialise the Title
+        """
+        super().__init__(game,
+                        [(TITLE_TIME, [Message("Angry Clones!", (220,250),
+                                               95)])],
+                        self.play)
+
+    def show(self):
+        """
+        Draws the title straight away, before the game loop runs
+        """
+        self.game.renderer.set_background(Image("greyed_out.jpg").img)
+        self.draw()
+
+    def enter(self):
+        """
+        Starts the title's time, it has already been drawn by show()
+        """
+        super().enter()
+        self.changed = False
+
+    def draw(self):
+        """
+        Draws the title over its background
+        """
+        for message in self.phases[self.phase][1]:
+            message.submit(self.game.renderer)
+        self.game.renderer.end_frame()
+
+    def play(self):
+        """
+        Puts up the scenery and starts the first level
+        """
+        show_scenery(self.game.renderer)
+        return Play(self.game)
+
+class Play(Scene):
+    """
+    One attempt at a level, drawn every frame. The physics ticks at a
+    fixed rate, as many ticks as real time has passed, and the frames are
+    interpolated between them
+    """
+
+    def __init__(self, game, retrying=False):
+        """
+        Initialise the Play, retrying puts a failed level back as it was
+        loaded, in place, so it keeps its seed. Otherwise each level gets
+        its own seed, so it can be replayed
+        """
+        super().__init__(game)
+        self.retrying = retrying
+        self.reset = False
+        self.kind = 0
+        self.accumulator = 0.0
+
+    def enter(self):
+        """
+        Sets the level up and starts recording the attempt
+        """
+        super().enter()
+        game = self.game
+        world = game.world
+        if self.retrying:
+            world.retry()
+        else:
+            game.seed = random.randrange(2**32)
+            world.build_level(game.level, game.seed)
+        if game.recorder is not None:
+            game.recorder.start(world, game.level, game.seed)
+        game.trajectory.level(world.data)
+        self.kind = world.ball().kind
+        self.accumulator = 0.0
+        game.clock.tick()
+        game.renderer.invalidate()
+
+    def timeout(self):
+        """
+        Play never waits for events, it draws every frame
+        """
+        return 0
+
+    def key(self, key):
+        """
+        Spacebar loads another ball, 1, 2 and 3 load a ball of that kind
+        """
+        if key == K_SPACE:
+            self.reset = True
+        picked = key - K_1
+        if 0 <= picked < len(engine.PROJECTILES):
+            self.kind = picked
+            self.reset = True
+
+    def update(self):
+        """
+        Runs the physics ticks due and draws a frame, then waits for the
+        next one. Returns the screen after the attempt once it is over
+        """
+        game = self.game
+        world = game.world
+        renderer = game.renderer
+        recorder = game.recorder
+
+        with frame_profiler.section("events"):
+            #Get ramp slope from mouse 'y'
+            rampsize = to_pygame(pygame.mouse.get_pos())[1]
+            firing = pygame.mouse.get_pressed()[0]
+
+        with frame_profiler.section("physics"):
+            # Inputs only reach the world through its ticks, so
+            # the recording of them plays out the same
+            while self.accumulator >= engine.STEP:
+                if recorder is not None:
+                    recorder.tick(rampsize, firing, self.reset, self.kind)
+                world.tick(rampsize, firing, self.reset, game.force/3,
+                           self.kind)
+                self.reset = False
+                self.accumulator -= engine.STEP
+
+        # How far between the last two physics ticks to draw
+        alpha = self.accumulator / engine.STEP
+
+        # Only the parts of the screen that changed are redrawn,
+        # and only sprites in view are drawn at all
+        with frame_profiler.section("sprites"):
+            sprites = world.sprites(alpha, game.view)
+            for entity, surface, rect in sprites:
+                renderer.sprite(entity, surface, rect)
+        with frame_profiler.section("preview"):
+            ball = world.ball()
+            if ball.get_position()[0] < world.ramp.start[0]:
+                path = game.trajectory.path(rampsize, ball.kind)
+                for key, surface, rect in preview_sprites(path):
+                    renderer.sprite(key, surface, rect)
+        frame_profiler.count("bodies", len(world.space.bodies))
+        frame_profiler.count("balls", len(world.balls))
+        frame_profiler.count("shapes", len(world.space.shapes))
+        frame_profiler.count("visible", len(sprites))
+        if world.is_large and frame_profiler.enabled:
+            frame_profiler.count("sleeping", world.sleeping())
+
+        for snake in world.snakes:
+            if snake.already_killed_snake:
+                Message("The Snake is Dead!", (600,600)).submit(renderer)
+                break
+
+        #Draw Ramp
+        renderer.sprite("ramp", *world.ramp.sprite())
+
+        #Display number of snakes left
+        Message("Snakes Left: {0}".format(world.snakes_alive), (0,0), 30)\
+                                                          .submit(renderer)
+
+        #Display the kind of ball loaded
+        Message("Ball: {0}".format(
+            engine.PROJECTILES[world.ball().kind][0]), (420,0), 30)\
+                                                          .submit(renderer)
+
+        #Time attack for levels with a timer, in physics time
+        time_left = world.time_left()
+        if time_left is not None:
+            Message("Time Left: {0}".format(time_left), (830,0), 30)\
+                                                          .submit(renderer)
+
+        if game.input.overlay:
+            submit_profile_overlay(renderer)
+
+        renderer.end_frame()
+
+        #If you kill all the snakes you win the level, if time
+        #runs out first you fail it. The rules are the engine's
+        if world.won() or world.failed():
+            return self.finish()
+
+        # Wait for the next frame, then run as many physics ticks as real
+        # time has passed
+        frame_time = game.clock.tick(game.fps) / 1000.0
+        self.accumulator += min(frame_time, MAX_FRAME_TIME)
+        frame_profiler.end_frame()
+        return self
+
+    def finish(self):
+        """
+        Ends the attempt and returns the screen that follows it
+        """
+        game = self.game
+        world = game.world
+        # Add up the physics time of every attempt, to see how fast
+        # you complete the game
+        game.time_taken += world.time()
+        if game.recorder is not None:
+            game.recorder.finish()
+
+        # FAILED: Ask if you would like to try again
+        if world.failed():
+            return Screen(game, [
+                (GOOD_TRY_TIME, [Message("Good Try!", (320,250), 95)]),
+                (None, [Message("Press SPACE to try again", (80,250), 80),
+                        Message("Press ESC to quit", (300,400), 60)]),
+            ], lambda: Play(game, retrying=True))
+
+        # Completed the game
+        if game.level == len(engine.LEVELS) - 1:
+            return Screen(game, [
+                (MESSAGE_TIME, [Message("Game Completed!", (130,250), 95)]),
+                (SCREEN_TIME, [Message("You completed the game", (190,250),
+                                       65),
+                               Message("In: {0} seconds".format(
+                                   int(game.time_taken)), (230,350), 95)]),
+            ], lambda: None)
+
+        # Show the next level screen
+        game.level += 1
+        return Screen(game, [
+            (MESSAGE_TIME, [Message("Well Done", (320,250), 95)]),
+            (SCREEN_TIME, [Message("Level {0}".format(game.level + 1),
+                                   (350,250), 95)]),
+        ], lambda: Play(game))
+
+class Watch(Scene):
+    """
+    Plays recorded attempts back as they were played, speed times as
+    fast, drawn every frame. Space skips to the next attempt. Prints
+    whether each attempt ended in the state it was recorded ending in
+    """
+
+    def __init__(self, game, recordings, speed=1.0):
+        """
+        Initialise the Watch
+        """
+        super().__init__(game)
+        self.recordings = iter(recordings)
+        self.speed = speed
+        self.recording = None
+        self.ticks = None
+        self.accumulator = 0.0
+        self.skipped = False
+
+    def enter(self):
+        """
+        Starts the first attempt
+        """
+        super().enter()
+        self.next_recording()
+
+    def next_recording(self):
+        """
+        Builds the level of the next attempt, returns False once there
+        are none left
+        """
+        self.recording = next(self.recordings, None)
+        if self.recording is None:
+            return False
+        world = self.game.world
+        world.substeps = self.recording.substeps
+        world.build_level(self.recording.level, self.recording.seed)
+        self.ticks = iter(self.recording.ticks)
+        self.accumulator = 0.0
+        self.skipped = False
+        self.game.clock.tick()
+        self.game.renderer.invalidate()
+        return True
+
+    def timeout(self):
+        """
+        Watch never waits for events, it draws every frame
+        """
+        return 0
+
+    def key(self, key):
+        """
+        Space skips to the next attempt
+        """
+        if key == K_SPACE:
+            self.skipped = True
+
+    def update(self):
+        """
+        Plays the ticks due and draws a frame, moving on to the next
+        attempt when one ends. Returns None after the last
+        """
+        if self.recording is None:
+            return None
+        game = self.game
+        world = game.world
+        renderer = game.renderer
+        frame_time = game.clock.tick(game.fps) / 1000.0
+        self.accumulator += min(frame_time, MAX_FRAME_TIME) * self.speed
+
+        playing = not self.skipped
+        while playing and self.accumulator >= engine.STEP:
+            tick = next(self.ticks, None)
+            if tick is None:
+                playing = False
+                break
+            rampsize, flags = tick
+            world.tick(rampsize, flags & replay.FIRE, flags & replay.RESET,
+                       kind=flags >> replay.KIND_SHIFT)
+            self.accumulator -= engine.STEP
+
+        if not playing:
+            if not self.skipped:
+                crc = replay.checksum(world)
+                print("{0}: {1}".format(self.recording, "matches"
+                                        if crc == self.recording.checksum
+                                        else "MISMATCH"))
+            if not self.next_recording():
+                return None
+
+        alpha = min(self.accumulator / engine.STEP, 1.0)
+        for entity, surface, rect in world.sprites(alpha, game.view):
+            renderer.sprite(entity, surface, rect)
+        renderer.sprite("ramp", *world.ramp.sprite())
+        Message("Replay: {0}".format(self.recording), (0,0), 30)\
+                                                        .submit(renderer)
+        renderer.end_frame()
+        return self
+
+class Game:
+    """
+    What the scenes share: the renderer, the input, the world and how far
+    through the levels the player is. run() is the game loop
+    """
+
+    def __init__(self, renderer, fps=60, overlay=False, recorder=None):
+        """
+        Initialise the Game, without a world yet
+        """
+        self.renderer = renderer
+        self.fps = fps
+        self.recorder = recorder
+        self.input = Input(renderer, overlay)
+        self.clock = pygame.time.Clock()
+        self.view = renderer.target.get_rect().inflate(VIEW_MARGIN * 2,
+                                                       VIEW_MARGIN * 2)
+        self.force = 2300 # Force upon the ball when it is fired
+        self.world = None
+        self.trajectory = None
+        self.level = 0
+        self.seed = None
+        self.time_taken = 0.0
+
+    def run(self, scene):
+        """
+        Runs scenes until one is followed by None. Each turn waits for
+        events as long as the scene can, hands them to it and updates it
+        """
+        scene.enter()
+        while scene is not None:
+            timeout = scene.timeout()
+            if timeout == 0:
+                with frame_profiler.section("events"):
+                    self.input.poll(scene)
+            else:
+                self.input.wait(scene, timeout)
+            following = scene.update()
+            if following is not scene and following is not None:
+                following.enter()
+            scene = following
+
+    def close(self):
+        """
+        Frees the world and the trajectory's world
+        """
+        if self.world is not None:
+            self.world.close()
+        if self.trajectory is not None:
+            self.trajectory.close()
+
+def main(substeps=None, fps=60, overlay=False, recorder=None,
+         skip_title=False, preset=None):
+    """
+    Runs the game. The physics ticks at a fixed 30 Hz (engine.STEP) with
+    substeps physics steps per tick, 4 gives 120 Hz physics, whatever the
+    frame rate. The physics settings, and the substeps unless they are
+    given, come from preset, an engine.Preset. Frames are drawn at up to
+    fps frames per second, or as fast as possible if fps is 0,
+    interpolated between physics ticks.
+    F3 toggles the frame profiler overlay, overlay sets it showing.
+    Every attempt at a level is recorded by recorder, if there is one.
+    skip_title goes straight to the first level
+    """
+    # The title screen's image loads first, then the scenery's, the rest
+    # load behind them
+    first = ("machinarium_floor.jpg", "trebuchet.png")
+    if not skip_title:
+        first = ("greyed_out.jpg",) + first
+    renderer = setup_screen(first)
+    game = Game(renderer, fps, overlay, recorder)
+
+    # The title is shown straight away, while the rest of the images load
+    # and the world is set up
+    if not skip_title:
+        title = Title(game)
+        title.show()
+
+    # Physics world: ground, left wall, ball area and the ramp,
+    # which is moved in place to follow the mouse
+    game.world = GameWorld(substeps, interpolate=True, preset=preset)
+
+    # Where the ball will go, shown while it waits in the ball area
+    game.trajectory = engine.Trajectory(game.force/3, game.world.substeps,
+                                        preset=preset)
+
+    try:
+        if skip_title:
+            show_scenery(renderer)
+            game.run(Play(game))
+        else:
+            game.run(title)
+    finally:
+        game.close()
+
+def watch(recordings, fps=60, speed=1.0, preset=None):
+    """
+    Renders recorded attempts as they were played, speed times as fast.
+    Space skips to the next attempt. Prints whether each attempt ended in
+    the state it was recorded ending in, which it only can if preset is
+    the one they were played with
+    """
+    renderer = setup_screen()
+    show_scenery(renderer)
+    game = Game(renderer, fps)
+    game.world = GameWorld(interpolate=True, preset=preset)
+    try:
+        game.run(Watch(game, recordings, speed))
+    finally:
+        game.close()
+
+def export(recordings, output, fps=60, speed=1.0, preset=None):
+    """
+    Renders recorded attempts offscreen, as fast as they can be drawn, and
+    writes them to output at fps frames per second of the attempts played
+    speed times as fast, see frames.py for the outputs. Prints whether each
+    attempt ended in the state it was recorded ending in, then how much
+    faster than real time the frames were made. As with watch(), preset
+    has to be the one they were played with. Returns the FrameWriter, for
+    its counts
+    """
+    renderer = setup_offscreen()
+    show_scenery(renderer)
+    view = renderer.target.get_rect().inflate(VIEW_MARGIN * 2,
+                                              VIEW_MARGIN * 2)
+    world = GameWorld(interpolate=True, preset=preset)
+    writer = frames.FrameWriter(output, SCREEN_SIZE)
+    started = time.perf_counter()
+
+    try:
+        for recording in recordings:
+            world.substeps = recording.substeps
+            world.build_level(recording.level, recording.seed)
+            renderer.invalidate()
+            label = Message("Replay: {0}".format(recording), (0,0), 30)
+            ticks = iter(recording.ticks)
+            played = 0
+            frame = 0
+            playing = True
+
+            while playing:
+                # Ticks are counted from the frame number rather than
+                # accumulated, so rounding never drops or adds one
+                due = frame * speed / (fps * engine.STEP)
+                while playing and played + 1 <= due + 1e-9:
+                    tick = next(ticks, None)
+                    if tick is None:
+                        playing = False
+                        break
+                    rampsize, flags = tick
+                    world.tick(rampsize, flags & replay.FIRE,
+                               flags & replay.RESET,
+                               kind=flags >> replay.KIND_SHIFT)
+                    played += 1
+
+                alpha = min(max(due - played, 0.0), 1.0)
+                for entity, surface, rect in world.sprites(alpha, view):
+                    renderer.sprite(entity, surface, rect)
+                renderer.sprite("ramp", *world.ramp.sprite())
+                label.submit(renderer)
+                renderer.end_frame()
+                writer.write(renderer.target)
+                frame += 1
+
+            crc = replay.checksum(world)
+            print("{0}: {1}".format(recording, "matches"
+                                    if crc == recording.checksum else
+                                    "MISMATCH"))
+    finally:
+        writer.close()
+        world.close()
+
+    seconds = time.perf_counter() - started
+    print("Exported {0} frames in {1:.1f} s, {2:.0f} frames/s, {3:.1f}x "
+          "real time".format(writer.frames, seconds, writer.frames / seconds,
+                             writer.frames / float(fps) / seconds))
+    return writer
+
+def run(argv):
+    """
+    Entry point, parses the command line then runs the game
+    """
+    parser = argparse.ArgumentParser(description="Angry Clones")
+    parser.add_argument("--profile", nargs="?", const="-", metavar="FILE",
+                        help="run under cProfile and print a report at exit,"
+                             " or save the raw stats to FILE")
+    parser.add_argument("--profile-export", metavar="FILE",
+                        help="record frame section timings and write them"
+                             " to FILE at exit, as .csv or .json")
+    parser.add_argument("--overlay", action="store_true",
+                        help="start with the profiler overlay showing,"
+                             " F3 toggles it")
+    parser.add_argument("--fps", type=int, default=60,
+                        help="frame rate cap, 0 for uncapped")
+    parser.add_argument("--substeps", type=int, default=None,
+                        help="physics steps per 30 Hz game tick, the"
+                             " preset's by default")
+    parser.add_argument("--preset", default=engine.DEFAULT_PRESET,
+                        help="physics settings: {0}, or a JSON file of"
+                             " settings. Replays have to be watched with"
+                             " the preset they were played with".format(
+                                 ", ".join(sorted(engine.PRESETS))))
+    parser.add_argument("--record", metavar="FILE",
+                        help="record every attempt at a level to FILE")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="watch the attempts recorded in FILE")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="how many times as fast to watch a replay")
+    parser.add_argument("--export", metavar="OUTPUT",
+                        help="with --replay, draw the attempts offscreen and"
+                             " write their frames to OUTPUT: numbered PNGs"
+                             " if it has {0} in it, otherwise raw RGB to a"
+                             " file or pipe")
+    parser.add_argument("--skip-title", action="store_true",
+                        help="go straight to the first level")
+    parser.add_argument("--levels", metavar="DIRECTORY",
+                        help="play the levelN.json files in DIRECTORY, such"
+                             " as generator.py makes, instead of the"
+                             " game's own")
+    args = parser.parse_args(argv)
+
+    if args.levels:
+        engine.LEVELS = engine.load_levels(args.levels)
+    try:
+        preset = engine.find_preset(args.preset)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.replay:
+        try:
+            recordings = replay.load(args.replay)
+        except ValueError as error:
+            parser.error(str(error))
+        if args.export:
+            export(recordings, args.export, args.fps or 60, args.speed,
+                   preset)
+        else:
+            watch(recordings, args.fps, args.speed, preset)
+        return
+
+    recorder = replay.Recorder() if args.record else None
+
+    if args.profile_export:
+        frame_profiler.record = True
+
+    profile = cProfile.Profile() if args.profile else None
+    try:
+        if profile:
+            profile.runcall(main, args.substeps, args.fps, args.overlay,
+                            recorder, args.skip_title, preset)
+        else:
+            main(args.substeps, args.fps, args.overlay, recorder,
+                 args.skip_title, preset)
+    finally:
+        if recorder is not None:
+            recorder.save(args.record)
+        if profile:
+            if args.profile == "-":
+                pstats.Stats(profile).sort_stats("cumulative").print_stats(30)
+            else:
+                profile.dump_stats(args.profile)
+        if args.profile_export:
+            frame_profiler.export(args.profile_export)
 
 if __name__ == '__main__':
-    main()
+    run(sys.argv[1:])
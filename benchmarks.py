@@ -0,0 +1,761 @@
+"""
+Headless benchmarks and regression checks for Angry Clones
+
+Usage: python benchmarks.py <name> [<name> ...]
+       python benchmarks.py all
+"""
+
+import os
+import sys
+import math
+import random
+import statistics
+import subprocess
+import tempfile
+import json
+import time
+
+# No window is needed for any of the checks in here
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import pymunk as pm
+
+import angryclones
+import engine
+import generator
+import replay
+
+def setup_display():
+    """
+    Sets up the (dummy) display the game's draw methods render to
+    """
+    pygame.display.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode(angryclones.SCREEN_SIZE)
+    angryclones.assets.convert()
+    return screen
+
+def ramp_shape_count(frames=10000):
+    """
+    Steps the space for a number of frames while the ramp follows a
+    moving 'mouse', the shape count in the space must not grow
+    """
+    world = engine.World()
+    world.build_level(0)
+
+    start_count = len(world.space.shapes)
+    for frame in range(frames):
+        world.ramp.move(100 + frame % 400)
+        if frame % 300 == 0:
+            world.reset_ball()
+        if frame % 300 < 30:
+            world.fire()
+        world.step()
+
+    end_count = len(world.space.shapes)
+    print("ramp: {0} frames, shapes at start {1}, at end {2}"
+          .format(frames, start_count, end_count))
+    return start_count == end_count
+
+def rotation_cache(crates=200, frames=200):
+    """
+    Compares the frame time of drawing a number of tumbling crates with a
+    rotozoom per crate per frame against the shared rotation cache
+    """
+    screen = setup_display()
+    space = pm.Space()
+    random.seed(0)
+    boxes = [angryclones.Crate(space, (random.randint(0, 1000),
+                                       random.randint(100, 600)),
+                               i % 10 == 0)
+             for i in range(crates)]
+
+    def frame(step):
+        for i, crate in enumerate(boxes):
+            crate.crate.body.angle = (i + step) * 0.05
+
+    started = time.perf_counter()
+    for step in range(frames):
+        frame(step)
+        for crate in boxes:
+            body = crate.crate.body
+            img = pygame.transform.rotozoom(crate.crate_img,
+                                            math.degrees(body.angle), 1)
+            centre = angryclones.to_pygame(body.position)
+            screen.blit(img, img.get_rect(center=centre))
+    before = (time.perf_counter() - started) / frames
+
+    started = time.perf_counter()
+    for step in range(frames):
+        frame(step)
+        for crate in boxes:
+            crate.draw(screen)
+    after = (time.perf_counter() - started) / frames
+
+    print("rotation: {0} crates, rotozoom {1:.2f} ms/frame, "
+          "cached {2:.2f} ms/frame ({3:.1f}x)"
+          .format(crates, before * 1000, after * 1000, before / after))
+
+def level_loading(objects=1000, repeats=20):
+    """
+    Writes a level with a given number of crates and snakes to a file, then
+    times reading it, loading it into a world and clearing it again
+    """
+    snakes = objects // 20
+    crates = objects - snakes
+    data = {
+        "timer": 30,
+        "crates": [[100 + (i // 25) * 48, 123 + (i % 25) * 47]
+                   for i in range(crates)],
+        "snakes": [[120 + i * 90, 1400] for i in range(snakes)],
+    }
+    handle, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(handle, "w") as level_file:
+        json.dump(data, level_file)
+
+    read = fresh = reload = clear = 0.0
+    try:
+        for repeat in range(repeats):
+            world = engine.World()
+            started = time.perf_counter()
+            level = engine.load_level(path)
+            loaded = time.perf_counter()
+            world.load(level)
+            built = time.perf_counter()
+            world.clear()
+            cleared = time.perf_counter()
+            world.load(level)
+            rebuilt = time.perf_counter()
+
+            read += loaded - started
+            fresh += built - loaded
+            clear += cleared - built
+            reload += rebuilt - cleared
+    finally:
+        os.remove(path)
+
+    print("levels: {0} objects, read {1:.2f} ms, load {2:.2f} ms, "
+          "clear {3:.2f} ms, reload {4:.2f} ms"
+          .format(objects, read / repeats * 1000, fresh / repeats * 1000,
+                  clear / repeats * 1000, reload / repeats * 1000))
+
+def dirty_rendering(frames=300):
+    """
+    Compares redrawing and flipping the whole screen every frame against
+    the dirty rect Renderer, on level 2 with a ball rolling about. The
+    same frames rendered to an offscreen surface must come out the same
+    as on the display
+    """
+    screen = setup_display()
+    background = angryclones.assets.image("machinarium_floor.jpg")
+
+    def play(draw_frame):
+        world = angryclones.GameWorld(interpolate=True)
+        world.build_level(1)
+        pixels = 0
+        started = time.perf_counter()
+        for frame in range(frames):
+            if frame < 20:
+                world.fire()
+            world.step()
+            pixels += draw_frame(world)
+        seconds = time.perf_counter() - started
+        return seconds / frames * 1000, pixels // frames
+
+    def full(world):
+        screen.blit(background, (0, 0))
+        for entity in world.balls + world.crates + world.snakes:
+            entity.draw(screen, 0.5)
+        world.ramp.draw(screen)
+        angryclones.Message("Snakes Left: {0}".format(world.snakes_alive),
+                            (0,0), 30).display_shadow(screen)
+        pygame.display.flip()
+        return screen.get_width() * screen.get_height()
+
+    def dirty_frames(target):
+        renderer = angryclones.Renderer(target)
+        renderer.set_background(background)
+        def dirty(world):
+            for entity in world.balls + world.crates + world.snakes:
+                renderer.sprite(entity, *entity.sprite(0.5))
+            renderer.sprite("ramp", *world.ramp.sprite())
+            angryclones.Message("Snakes Left: {0}".format(world.snakes_alive),
+                                (0,0), 30).submit(renderer)
+            renderer.end_frame()
+            return renderer.pixels_pushed
+        return dirty
+
+    full_ms, full_pixels = play(full)
+    dirty_ms, dirty_pixels = play(dirty_frames(screen))
+    offscreen = pygame.Surface(screen.get_size())
+    offscreen_ms, offscreen_pixels = play(dirty_frames(offscreen))
+    same = (pygame.image.tostring(offscreen, "RGB") ==
+            pygame.image.tostring(screen, "RGB"))
+    print("dirty: full redraw {0:.2f} ms/frame {1} px/frame, "
+          "dirty rects {2:.2f} ms/frame {3} px/frame, offscreen {4:.2f} "
+          "ms/frame {5}".format(full_ms, full_pixels, dirty_ms, dirty_pixels,
+                                offscreen_ms, "matches" if same else
+                                "DIFFERS from the display"))
+    return same
+
+def stress_level(crates=2000, rows=8, spacing=60):
+    """
+    Returns a large level of crates stacked rows high in columns spacing
+    apart, on a ground wide enough to hold them
+    """
+    columns = (crates + rows - 1) // rows
+    return {
+        "timer": None,
+        "ground": engine.GROUND,
+        "width": 200 + columns * spacing,
+        "crates": [[150 + (i // rows) * spacing, 123 + (i % rows) * 46.5]
+                   for i in range(crates)],
+        "tnt": [],
+        "broken": [],
+        "snakes": [[150 + columns * spacing, 123]],
+    }
+
+def large_level(crates=2000, frames=300):
+    """
+    Plays a level of a couple of thousand crates with and without large
+    level mode: the level is left to settle, then the ball is fired into
+    it while each frame is stepped and drawn as the game does
+    """
+    screen = setup_display()
+    renderer = angryclones.Renderer(screen)
+    renderer.set_background(angryclones.assets.image("machinarium_floor.jpg"))
+    view = screen.get_rect().inflate(angryclones.VIEW_MARGIN * 2,
+                                     angryclones.VIEW_MARGIN * 2)
+    level = stress_level(crates)
+
+    for large in (False, True):
+        world = angryclones.GameWorld(interpolate=True, large=large)
+        world.load(level)
+        for tick in range(120):
+            world.step()
+
+        visible = 0
+        started = time.perf_counter()
+        for frame in range(frames):
+            if frame < 20:
+                world.fire()
+            world.step()
+            sprites = world.sprites(1.0, view)
+            for entity, surface, rect in sprites:
+                renderer.sprite(entity, surface, rect)
+            renderer.end_frame()
+            visible += len(sprites)
+        frame_time = (time.perf_counter() - started) / frames
+
+        print("large: {0} crates, large mode {1}, {2:.2f} ms/frame "
+              "({3:.0f} FPS), {4} asleep, {5} in view"
+              .format(crates, "on" if large else "off", frame_time * 1000,
+                      1 / frame_time, world.sleeping(), visible // frames))
+
+def entity_store(crates=1000, frames=200):
+    """
+    Compares building each frame's sprites entity by entity against the
+    NumPy EntityStore, for a level of crates tumbling down on screen
+    """
+    if angryclones.EntityStore is None:
+        print("store: NumPy isn't installed, skipped")
+        return
+    screen = setup_display()
+    view = screen.get_rect().inflate(angryclones.VIEW_MARGIN * 2,
+                                     angryclones.VIEW_MARGIN * 2)
+    level = {
+        "timer": None,
+        "crates": [[60 + (i % 20) * 47, 123 + (i // 20) * 47]
+                   for i in range(crates)],
+        "snakes": [],
+    }
+
+    def play(use_store):
+        world = angryclones.GameWorld(interpolate=True, large=False)
+        if not use_store:
+            world.store = None
+        world.load(level)
+        seconds = 0.0
+        for frame in range(frames):
+            world.step()
+            started = time.perf_counter()
+            sprites = world.sprites(0.5, view)
+            screen.blits([(surface, rect)
+                          for entity, surface, rect in sprites], False)
+            seconds += time.perf_counter() - started
+        return seconds / frames * 1000, len(sprites)
+
+    objects_ms, drawn = play(False)
+    store_ms, drawn = play(True)
+    print("store: {0} crates, {1} in view at the end, per entity "
+          "{2:.2f} ms/frame, store {3:.2f} ms/frame ({4:.1f}x)"
+          .format(crates, drawn, objects_ms, store_ms, objects_ms / store_ms))
+
+def replay_playback(ticks=900):
+    """
+    Records a scripted attempt at every level, saves and loads it, then
+    plays each one back twice: once in a fresh World and once in a World
+    that has played other levels first. Both must end in the recorded
+    state bit for bit
+    """
+    recorder = replay.Recorder()
+    for level in range(len(engine.LEVELS)):
+        world = engine.World()
+        world.build_level(level, level + 1)
+        recorder.start(world, level, level + 1)
+        for tick in range(ticks):
+            inputs = (100 + tick * 7 % 300, tick % 150 < 12,
+                      tick % 150 == 140)
+            recorder.tick(*inputs)
+            world.tick(*inputs)
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "benchmark.acrp")
+    recorder.save(path)
+
+    matched = True
+    reused = engine.World()
+    for recording in replay.load(path):
+        started = time.perf_counter()
+        fresh_crc = replay.play(recording)[1]
+        seconds = time.perf_counter() - started
+        reused_crc = replay.play(recording, reused)[1]
+        ok = fresh_crc == reused_crc == recording.checksum
+        matched = matched and ok
+        print("replay: {0}, {1:.0f} ticks/s, {2}".format(
+            recording, len(recording.ticks) / seconds,
+            "bit exact" if ok else "MISMATCH"))
+    os.remove(path)
+    os.rmdir(folder)
+    return matched
+
+def trajectory_preview(frames=600, limit=2.0):
+    """
+    Aims like a player sweeping the mouse up and down the screen while the
+    trajectory preview is worked out and turned into sprites each frame.
+    99% of frames must stay under limit ms, and the preview must follow
+    the ball fired for real in a level
+    """
+    setup_display()
+    trajectory = engine.Trajectory()
+    started = time.perf_counter()
+    trajectory.path(333)
+    cold = (time.perf_counter() - started) * 1000
+    trajectory = engine.Trajectory()
+
+    times = []
+    for frame in range(frames):
+        rampsize = 350 + 250 * math.sin(frame / 40.0)
+        started = time.perf_counter()
+        angryclones.preview_sprites(trajectory.path(rampsize))
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+
+    # The preview against the ball fired for real, until it nears the
+    # level's crates
+    world = engine.World()
+    world.build_level(0)
+    for tick in range(engine.SETTLE_TICKS):
+        world.step()
+    path = trajectory.path(300)
+    world.ramp.move(300)
+    ball = world.ball()
+    error = 0.0
+    for x, y in path[:25]:
+        world.tick(300, ball.get_position()[0] < world.ramp.end[0])
+        position = ball.get_position()
+        error = max(error, abs(position[0] - x), abs(position[1] - y))
+
+    print("preview: first path {0:.2f} ms, {1} frames aiming p50 {2:.3f} "
+          "p99 {3:.3f} max {4:.3f} ms, {5} paths cached, off by {6:.2f} px"
+          .format(cold, frames, times[len(times) // 2],
+                  times[len(times) * 99 // 100], times[-1],
+                  len(trajectory.paths), error))
+    return times[len(times) * 99 // 100] < limit and error < 1.0
+
+def interpolation(ticks=30):
+    """
+    Fires the ball at the first level and checks that every ball, crate
+    and snake is drawn from where it was at the last physics tick with
+    alpha 0 and where it is now with alpha 1, with the ball moving in
+    between
+    """
+    world = engine.World(interpolate=True)
+    world.build_level(0)
+    entities = world.balls + world.crates + world.snakes
+    moved = 0
+    matched = True
+    for tick in range(ticks):
+        before = [tuple(entity.shape.body.position) for entity in entities]
+        world.tick(300, tick < 15)
+        for entity, previous in zip(entities, before):
+            start = entity.interpolated(0.0)[0]
+            end = entity.interpolated(1.0)[0]
+            current = tuple(entity.shape.body.position)
+            matched = (matched and tuple(start) == previous and
+                       tuple(end) == current)
+            if tuple(start) != tuple(end):
+                moved += 1
+
+    print("interpolation: {0} ticks, {1} entity positions moved between "
+          "alpha 0 and 1, {2}".format(
+              ticks, moved, "previous and current ticks match" if matched
+              else "MISMATCH"))
+    return matched and moved > 0
+
+# How many times quicker restoring a level in place must be than loading
+# it afresh, see level_retry
+RETRY_SPEEDUP = 1.2
+
+def level_retry(crates=1000, ticks=150, repeats=10):
+    """
+    Times trying a level of crates again by loading it afresh against
+    restoring it in place, after the ball has been fired into it, over a
+    number of repeats. Both must then play out the same, bit for bit, and
+    restoring must be RETRY_SPEEDUP times quicker than the load just
+    before it, going by the median of the repeats.
+    Restoring still takes every body and shape out of the space and adds
+    it again, as that is the only way to empty Chipmunk's contact cache
+    and rebuild its index as a loaded level has them. Loading does that
+    too, so restoring can't be much more than twice as quick
+    """
+    level = stress_level(crates)
+
+    def play(world):
+        for tick in range(ticks):
+            world.tick(100 + tick * 7 % 300, tick % 150 < 12,
+                       tick % 150 == 140)
+        return replay.checksum(world)
+
+    setup_display()
+    world = angryclones.GameWorld(interpolate=True)
+    world.load(level, 1)
+    loads = []
+    restores = []
+    exact = True
+    for repeat in range(repeats):
+        play(world)
+        started = time.perf_counter()
+        world.load(level, 1)
+        loads.append(time.perf_counter() - started)
+        fresh = play(world)
+
+        started = time.perf_counter()
+        world.retry()
+        restores.append(time.perf_counter() - started)
+        exact = exact and play(world) == fresh
+
+    # Each restore is set against the load just before it, as a slow
+    # spell of the machine tends to slow both
+    speedup = statistics.median(loaded / restored for loaded, restored
+                                in zip(loads, restores))
+    quick = speedup >= RETRY_SPEEDUP
+    print("retry: {0} crates, load {1:.2f} ms, restore {2:.2f} ms ({3:.1f}x"
+          "{4}), {5}".format(crates, statistics.median(loads) * 1000,
+                             statistics.median(restores) * 1000,
+                             speedup, "" if quick else
+                             ", under {0}x".format(RETRY_SPEEDUP),
+                             "bit exact" if exact else "MISMATCH"))
+    return exact and quick
+
+def projectile_pool(ticks=3000, every=20):
+    """
+    Plays a long session on a level, loading a ball of the next kind
+    every few ticks and firing it off. Balls must be recycled through the
+    World's pool and taken out as they land, keeping the number of bodies
+    and ball objects flat
+    """
+    world = engine.World()
+    world.build_level(1)
+    bodies = len(world.space.bodies)
+    most = 0
+    made = set()
+    kinds = len(engine.PROJECTILES)
+
+    started = time.perf_counter()
+    for tick in range(ticks):
+        load = tick % every == 0
+        kind = tick // every % kinds
+        world.tick(150 + tick * 7 % 300, tick % every < 8, load, kind=kind)
+        most = max(most, len(world.balls))
+        made.update(id(ball) for ball in world.balls)
+    seconds = time.perf_counter() - started
+
+    print("balls: {0} loaded over {1} ticks, {2:.3f} ms/tick, at most {3} "
+          "in play, {4} ball objects made, bodies {5} -> {6}".format(
+              ticks // every, ticks, seconds / ticks * 1000, most,
+              len(made), bodies, len(world.space.bodies)))
+    return (most <= engine.MAX_BALLS and
+            len(made) <= engine.MAX_BALLS + kinds and
+            len(world.space.bodies) - bodies < engine.MAX_BALLS)
+
+# Run in a fresh interpreter by core_footprint, imports the modules given
+# and builds a level, then prints how long that took, the peak memory and
+# whether pygame was loaded
+FOOTPRINT_SCRIPT = """
+import time
+started = time.perf_counter()
+import importlib, json, sys
+for name in sys.argv[1:]:
+    importlib.import_module(name)
+import engine
+engine.World().build_level(0)
+seconds = time.perf_counter() - started
+with open("/proc/self/status") as status:
+    rss = [int(line.split()[1]) for line in status
+           if line.startswith("VmHWM")][0]
+print(json.dumps({"seconds": seconds, "rss": rss,
+                  "pygame": "pygame" in sys.modules}))
+"""
+
+def core_footprint():
+    """
+    Compares a process that only uses the engine, as the solver's workers
+    and replay checks do, with one that loads the game. The engine must
+    not pull in pygame. Peak memory is read from /proc, so Linux only
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy")
+    results = {}
+    for modules in (["engine", "replay", "solver"], ["angryclones"]):
+        output = subprocess.check_output(
+            [sys.executable, "-c", FOOTPRINT_SCRIPT] + modules, cwd=here,
+            env=env, stderr=subprocess.DEVNULL, universal_newlines=True)
+        results[modules[0]] = result = json.loads(output.splitlines()[-1])
+        print("core: {0:<24} {1:6.1f} ms to a built level, {2:6.1f} MiB, "
+              "pygame {3}loaded".format(" ".join(modules),
+                                        result["seconds"] * 1000,
+                                        result["rss"] / 1024.0,
+                                        "" if result["pygame"] else "not "))
+    return not results["engine"]["pygame"]
+
+# Run in a fresh interpreter by startup_time, so imports are timed too.
+# Marks the first frame pushed to the display and the first frame of the
+# first level, the first with anything on the world layer, then prints
+# the times and quits
+STARTUP_SCRIPT = """
+import time
+started = time.perf_counter()
+import json, os, sys
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+import pygame
+marks = {}
+flip = pygame.display.flip
+def first_flip():
+    flip()
+    marks.setdefault("frame", time.perf_counter() - started)
+pygame.display.flip = first_flip
+import angryclones
+end_frame = angryclones.Renderer.end_frame
+def first_level_frame(renderer):
+    if not renderer.layers[angryclones.WORLD_LAYER]:
+        return end_frame(renderer)
+    marks.setdefault("frame", time.perf_counter() - started)
+    marks["interactive"] = time.perf_counter() - started
+    print(json.dumps(marks))
+    raise SystemExit
+angryclones.Renderer.end_frame = first_level_frame
+angryclones.run(sys.argv[1:])
+"""
+
+def startup_time(runs=5):
+    """
+    Launches the game in a fresh interpreter a few times, with and without
+    the title screen, and reports the best time to its first frame and to
+    the first frame of the first level
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    for argv in ([], ["--skip-title"]):
+        marks = []
+        for run in range(runs):
+            output = subprocess.check_output(
+                [sys.executable, "-c", STARTUP_SCRIPT] + argv, cwd=here,
+                stderr=subprocess.DEVNULL, universal_newlines=True)
+            marks.append(json.loads(output.splitlines()[-1]))
+        print("startup: {0:<12} first frame {1:6.1f} ms, interactive "
+              "{2:6.1f} ms".format(
+                  " ".join(argv) or "title",
+                  min(m["frame"] for m in marks) * 1000,
+                  min(m["interactive"] for m in marks) * 1000))
+
+def tnt_chain(tnt=400, rows=6, spacing=93, ticks=300):
+    """
+    Fires the ball into a level of hundreds of TNT crates stacked close
+    enough for each blast to set off the next, the whole chain reaction
+    has to go off within one tick
+    """
+    columns = (tnt + rows - 1) // rows
+    level = {
+        "timer": None,
+        "ground": engine.GROUND,
+        "width": 400 + columns * spacing,
+        "crates": [],
+        "tnt": [[300 + (i // rows) * spacing, 147 + (i % rows) * spacing]
+                for i in range(tnt)],
+        "broken": [],
+        "snakes": [[350 + columns * spacing, 123]],
+    }
+    world = engine.World()
+    world.load(level)
+    for tick in range(120):
+        world.step()
+
+    times = []
+    went_off = []
+    for tick in range(ticks):
+        exploded = world.exploded()
+        started = time.perf_counter()
+        world.tick(150, tick < 20)
+        times.append(time.perf_counter() - started)
+        went_off.append(world.exploded() - exploded)
+
+    chain = max(range(ticks), key=lambda tick: went_off[tick])
+    blasts = went_off[chain]
+    others = times[:chain] + times[chain + 1:]
+    print("tnt: {0} TNT crates, {1} went off in one tick of {2:.2f} ms "
+          "({3:.3f} ms a blast), other ticks {4:.2f} ms".format(
+              tnt, blasts, times[chain] * 1000,
+              times[chain] * 1000 / max(blasts, 1),
+              sum(others) / len(others) * 1000))
+    return blasts == tnt
+
+def replay_export(ticks=300, fps=30):
+    """
+    Records a scripted attempt at the first level and exports it offscreen
+    as raw RGB frames to the null device, reporting how many times real
+    time the frames were made. Every frame must have been written whole
+    """
+    world = engine.World()
+    world.build_level(0, 1)
+    recording = replay.Recording(0, 1)
+    for tick in range(ticks):
+        inputs = (100 + tick * 7 % 300, tick % 150 < 12, tick % 150 == 140)
+        recording.add(*inputs)
+        world.tick(*inputs)
+    recording.checksum = replay.checksum(world)
+
+    started = time.perf_counter()
+    writer = angryclones.export([recording], os.devnull, fps)
+    seconds = time.perf_counter() - started
+    width, height = angryclones.SCREEN_SIZE
+    print("export: {0} frames at {1} fps, {2:.0f} frames/s, {3:.1f}x real "
+          "time, {4:.2f} s waiting on the writer".format(
+              writer.frames, fps, writer.frames / seconds,
+              writer.frames / float(fps) / seconds, writer.waited))
+    return writer.bytes == writer.frames * width * height * 3
+
+def level_generation(count=16, workers=None):
+    """
+    Generates levels on every core and reports how many a minute are made.
+    Every level has to settle the same again from its seed, stand still
+    once loaded and be won by the shot found for it
+    """
+    levels = generator.Generator(workers)
+    started = time.perf_counter()
+    made = list(levels.levels(count))
+    seconds = time.perf_counter() - started
+    print("generator: {0} levels from {1} candidates ({2} unstable, {3} "
+          "unsolvable), {4:.0f} levels/minute on {5} workers".format(
+              len(made), levels.candidates, levels.unstable,
+              levels.unsolvable, len(made) * 60 / seconds, levels.workers))
+
+    world = engine.World()
+    ok = True
+    for data in made:
+        again = generator.settle(world, generator.generate(data["seed"]))
+        world.load(data)
+        rampsize, force, hold, delay = data["solution"]
+        shot = engine.Shot(rampsize, force, hold, delay)
+        ok = (ok and again["crates"] == data["crates"] and
+              generator.standing(world) and
+              engine.simulate(data, shot, levels.max_time, world).won())
+    return ok
+
+def physics_presets(crates=120, rows=10, ticks=300):
+    """
+    Stands towers of crates rows high under each physics preset and
+    reports how fast the physics steps against how far the crates drift
+    once the towers have settled. The towers must stay up under every
+    preset
+    """
+    level = stress_level(crates, rows)
+    ok = True
+    for name in ("fast", "balanced", "accurate"):
+        world = engine.World(preset=engine.PRESETS[name])
+        world.load(level)
+        started = time.perf_counter()
+        for tick in range(60):
+            world.step()
+        settled = [tuple(crate.shape.body.position) for crate in world.crates]
+        for tick in range(ticks):
+            world.step()
+        seconds = time.perf_counter() - started
+
+        drift = [math.hypot(x - crate.shape.body.position[0],
+                            y - crate.shape.body.position[1])
+                 for (x, y), crate in zip(settled, world.crates)]
+        print("presets: {0:<8} {1} substeps, {2:6.0f} physics steps/s "
+              "({3:5.0f} ticks/s), drift once settled mean {4:.3f} max "
+              "{5:.3f} px, {6} asleep".format(
+                  name, world.substeps,
+                  (60 + ticks) * world.substeps / seconds,
+                  (60 + ticks) / seconds, sum(drift) / len(drift),
+                  max(drift), world.sleeping()))
+        ok = ok and max(drift) < 10
+    return ok
+
+def asset_loading():
+    """
+    Preloads every asset into a fresh registry and reports the time and
+    memory each one took
+    """
+    setup_display()
+    registry = angryclones.Assets()
+    registry.preload()
+    print("assets:")
+    for line in registry.report():
+        print("  " + line)
+
+
+BENCHMARKS = {
+    "assets": asset_loading,
+    "balls": projectile_pool,
+    "core": core_footprint,
+    "dirty": dirty_rendering,
+    "export": replay_export,
+    "generator": level_generation,
+    "interpolation": interpolation,
+    "large": large_level,
+    "levels": level_loading,
+    "presets": physics_presets,
+    "preview": trajectory_preview,
+    "ramp": ramp_shape_count,
+    "replay": replay_playback,
+    "retry": level_retry,
+    "startup": startup_time,
+    "rotation": rotation_cache,
+    "store": entity_store,
+    "tnt": tnt_chain,
+}
+
+def main(argv):
+    names = argv or ["all"]
+    if names == ["all"]:
+        names = sorted(BENCHMARKS)
+
+    failed = []
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark: {0}".format(name))
+            print("Choose from: {0}".format(", ".join(sorted(BENCHMARKS))))
+            return 2
+        if BENCHMARKS[name]() is False:
+            failed.append(name)
+
+    if failed:
+        print("FAILED: {0}".format(", ".join(failed)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
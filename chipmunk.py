@@ -0,0 +1,177 @@
+"""
+Chipmunk's private fields, for Angry Clones
+
+pymunk 4.0 describes Chipmunk 6.2's structs to ctypes, and the engine
+reads and writes fields of them pymunk doesn't expose: shape ids, the
+solver's correction velocities and whole runs of a body's struct. Those
+descriptions are only right for the library pymunk was built with, so on
+import each field used here is checked against the loaded library, by
+setting it through Chipmunk's own functions and reading it back or the
+other way round. A library laid out differently fails here, rather than
+playing replays out differently or writing over memory
+"""
+
+import ctypes
+import math
+
+import pymunk as pm
+
+if not pm.version.startswith("4.0."):
+    raise ImportError("Angry Clones needs pymunk 4.0, with Chipmunk 6.2, "
+                      "not pymunk {0}".format(pm.version))
+
+_lib = pm._chipmunk
+_cpBody = _lib.cpBody
+_cpFloat = ctypes.sizeof(_lib.cpFloat)
+
+# What changes about a body as it moves lies in two runs of Chipmunk's
+# body struct: its position through to the solver's correction
+# velocities, taking in its data pointer and speed limits which never
+# change, and how long it has been idle, the last field. They are copied
+# out and back as bytes, (start, end) offsets of each run
+BODY_STATE = ((_cpBody.p.offset, _cpBody.space_private.offset),
+              (_cpBody.node_private.offset +
+               _lib.cpComponentNode.idleTime.offset,
+               ctypes.sizeof(_cpBody)))
+
+_ZERO = pm.Vec2d(0, 0)
+_UNROTATED = pm.Vec2d(1, 0)
+
+def reset_body(body, position):
+    """
+    Puts a body back at rest at a position, so it can be reused. The body
+    must not be in a space
+    """
+    # Set in Chipmunk's body struct directly, it is three times quicker
+    # than through pymunk. The solver's correction velocities aren't
+    # exposed by pymunk but carry over from the body's last space all the
+    # same
+    cbody = body._bodycontents
+    cbody.p = position
+    cbody.v = _ZERO
+    cbody.f = _ZERO
+    cbody.a = 0
+    cbody.w = 0
+    cbody.t = 0
+    cbody.rot = _UNROTATED
+    cbody.v_bias_private = _ZERO
+    cbody.w_bias_private = 0
+
+def body_state(body):
+    """
+    Returns everything about a body that changes as it moves, to be put
+    back with set_body_state
+    """
+    return ctypes.string_at(body._body, ctypes.sizeof(_cpBody))
+
+def set_body_state(body, state):
+    """
+    Puts a body back in a state returned by body_state
+    """
+    address = ctypes.addressof(body._bodycontents)
+    for start, end in BODY_STATE:
+        ctypes.memmove(address + start, state[start:end], end - start)
+
+# Chipmunk 6.2 decides which of two colliding polygons comes first by where
+# in memory their shapes are, and walks its spatial index in the order of
+# the shapes' ids. Both depend on what the process did before, so the World
+# hands shapes to entities in memory order and numbers them itself, making
+# every level play out the same for the same inputs
+def shape_address(shape):
+    """
+    Returns where in memory Chipmunk keeps a shape
+    """
+    return ctypes.addressof(shape._shapecontents)
+
+def shape_id(shape):
+    """
+    Returns the id Chipmunk indexes a shape by
+    """
+    return shape._shapecontents.hashid_private
+
+def set_shape_id(shape, shape_id):
+    """
+    Sets the id Chipmunk indexes a shape by, the shape must not be in a
+    space
+    """
+    shape._shapecontents.hashid_private = shape_id
+
+def use_spatial_hash(space, cell, count):
+    """
+    Has a space index its shapes in a spatial hash of cells cell wide,
+    with room for about count shapes. pymunk 4 has no method for it
+    """
+    _lib.cpSpaceUseSpatialHash(space._space, cell, count)
+
+def _expect(field, got, wanted):
+    """
+    Raises ImportError unless a field read back from Chipmunk is what
+    was put in it
+    """
+    if isinstance(wanted, tuple):
+        matches = all(abs(a - b) < 1e-9 for a, b in zip(got, wanted))
+    else:
+        matches = abs(got - wanted) < 1e-9
+    if not matches:
+        raise ImportError("Chipmunk {0} doesn't lay out {1} as pymunk {2} "
+                          "says, got {3} not {4}".format(
+                              _lib.cpVersionString.value.decode(), field,
+                              pm.version, got, wanted))
+
+def _check_layout():
+    """
+    Checks every field used above against the loaded library
+    """
+    node = _cpBody.node_private.offset
+    idle_time = node + _lib.cpComponentNode.idleTime.offset
+    _expect("the end of cpBody", ctypes.sizeof(_cpBody),
+            idle_time + _cpFloat)
+
+    body = _lib.cpBodyNew(2.0, 4.0)
+    cbody = body.contents
+    _expect("cpBody.m", (cbody.m, cbody.m_inv), (2.0, 0.5))
+    _expect("cpBody.i", (cbody.i, cbody.i_inv), (4.0, 0.25))
+    _lib.cpBodySetPos(body, (3.0, 5.0))
+    _lib.cpBodySetAngle(body, 0.5)
+    _expect("cpBody.p", tuple(cbody.p), (3.0, 5.0))
+    _expect("cpBody.a", cbody.a, 0.5)
+    _expect("cpBody.rot", tuple(cbody.rot), (math.cos(0.5), math.sin(0.5)))
+
+    # Chipmunk integrates what is set here, and clears the corrections
+    cbody.v = (1.0, 2.0)
+    cbody.f = (2.0, 4.0)
+    cbody.w = 1.0
+    cbody.t = 8.0
+    _lib.cpBodyUpdateVelocity(body, (0.0, 0.0), 1.0, 1.0)
+    _expect("cpBody.v", tuple(cbody.v), (2.0, 4.0))
+    _expect("cpBody.w", cbody.w, 3.0)
+    cbody.v_bias_private = (1.0, 1.0)
+    cbody.w_bias_private = 1.0
+    _lib.cpBodyUpdatePosition(body, 1.0)
+    _expect("cpBody.v_bias", (cbody.p.x, cbody.p.y, cbody.v_bias_private.x,
+                              cbody.v_bias_private.y), (6.0, 10.0, 0.0, 0.0))
+    _expect("cpBody.w_bias", (cbody.a, cbody.w_bias_private), (4.5, 0.0))
+
+    space = _lib.cpSpaceNew()
+    _lib.cpSpaceUseSpatialHash(space, 10.0, 100)
+    _lib.cpSpaceAddBody(space, body)
+    _expect("cpBody.space", ctypes.cast(cbody.space_private,
+                                        ctypes.c_void_p).value,
+            ctypes.cast(space, ctypes.c_void_p).value)
+    idle = _lib.cpFloat.from_address(ctypes.addressof(cbody) + idle_time)
+    idle.value = 5.0
+    _lib.cpBodyActivate(body)
+    _expect("cpBody.node.idleTime", idle.value, 0.0)
+    _lib.cpSpaceRemoveBody(space, body)
+    _lib.cpSpaceFree(space)
+
+    # Chipmunk numbers shapes from its counter as they are made
+    _lib.cpResetShapeIdCounter()
+    shapes = [_lib.cpCircleShapeNew(body, 1.0, (0.0, 0.0)) for n in range(2)]
+    _expect("cpShape.hashid", tuple(shape.contents.hashid_private
+                                    for shape in shapes), (0, 1))
+    for shape in shapes:
+        _lib.cpShapeFree(shape)
+    _lib.cpBodyFree(body)
+
+_check_layout()
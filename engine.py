@@ -0,0 +1,1467 @@
+"""
+Headless physics engine for Angry Clones
+
+Builds the game's levels in a pymunk space and steps them without pygame or
+a display, so shots can be simulated as fast as the CPU allows. Along with
+the physics it has the game's rules: which snakes are dead, when a level is
+won and when its time has run out. It only needs pymunk, so batch workers
+can use it without loading pygame; the game adds drawing on top
+"""
+
+import json
+import math
+import os
+import random
+import time
+import weakref
+
+import pymunk as pm
+
+# Replays and retries only play out the same because the engine sets
+# Chipmunk's private fields itself. Every field it touches is in chipmunk,
+# which checks them against the loaded library and fails to import with
+# anything but pymunk 4.0
+import chipmunk
+
+STEP      = 1/30.0 # Game tick, inputs are applied once per tick
+SUBSTEPS  = 4      # Physics steps per tick, 120 Hz physics
+FORCE     = 2300   # Force upon the ball when it is fired
+RAMPSIZE  = 100    # Default end coordinate of the ball's ramp
+BALL_HOME = (2,110)
+GROUND    = 100    # Height of the ground
+GROUND_WIDTH = 1050
+
+# A snake touching the toxic puddle along the ground dies. It reaches
+# this high, so a snake 80 high dies once its centre is within 90 of it
+PUDDLE_DEPTH = 50
+PUDDLE_REACH = 20000
+
+# Projectiles the player can load, by kind: (name, mass, radius)
+PROJECTILES = (("ball", 5, 20), ("boulder", 12, 26), ("pebble", 2, 12))
+MAX_BALLS  = 8    # Balls in play at once, the oldest goes to make room
+BALL_GROUP = 1    # Balls pass through each other, see Ball
+REST_TICKS = 30   # Ticks a fired ball can lie still before it is taken out
+
+# Impulse a crate has to take in one collision to break
+BREAK_IMPULSE = 1000
+
+# TNT goes off when hit this hard, pushing away the bodies within
+# BLAST_RADIUS of it with up to BLAST_IMPULSE, less the further away they
+# are. Crates pushed hard enough by a blast break, and TNT goes off too
+TNT_IMPULSE   = BREAK_IMPULSE
+BLAST_RADIUS  = 150
+BLAST_IMPULSE = 4000
+
+# Large levels let resting bodies sleep, so settled crate towers cost
+# nothing to step until something hits them
+LARGE_LEVEL = 200      # Entities from which a level counts as large
+SLEEP_TIME  = 0.5      # Seconds a body must be idle before it sleeps
+IDLE_SPEED  = 10.0     # Speed below which a body counts as idle
+HASH_CELL   = 46       # Spatial hash cell size, a small crate's width
+
+class Preset:
+    """
+    Physics quality settings, trading how stiff and steady stacks of
+    crates are for how fast the physics steps: Chipmunk's solver
+    iterations, collision slop and damping, the physics steps per tick,
+    and from how many entities a level counts as large, so idle bodies
+    sleep after sleep_time seconds and a spatial hash of hash_cell sized
+    cells is used. Chipmunk's own defaults are kept for settings of None,
+    large_level None never counts a level as large
+    """
+
+    SETTINGS = ("iterations", "collision_slop", "damping", "substeps",
+                "large_level", "sleep_time", "hash_cell")
+
+    def __init__(self, name, iterations=None, collision_slop=None,
+                 damping=None, substeps=SUBSTEPS, large_level=LARGE_LEVEL,
+                 sleep_time=SLEEP_TIME, hash_cell=HASH_CELL):
+        """
+        Initialise the Preset
+        """
+        self.name = name
+        self.iterations = iterations
+        self.collision_slop = collision_slop
+        self.damping = damping
+        self.substeps = substeps
+        self.large_level = large_level
+        self.sleep_time = sleep_time
+        self.hash_cell = hash_cell
+
+    def settings(self):
+        """
+        Returns the settings as a dict
+        """
+        return dict((setting, getattr(self, setting))
+                    for setting in self.SETTINGS)
+
+    def apply(self, space):
+        """
+        Sets a new space's solver settings
+        """
+        for setting in ("iterations", "collision_slop", "damping"):
+            value = getattr(self, setting)
+            if value is not None:
+                setattr(space, setting, value)
+
+    def __repr__(self):
+        return "Preset({0}: {1})".format(self.name, ", ".join(
+            "{0} {1}".format(setting, getattr(self, setting))
+            for setting in self.SETTINGS))
+
+# balanced is how the game has always played, fast halves the physics rate
+# and lets resting bodies sleep on every level, accurate doubles it
+PRESETS = {
+    "fast":     Preset("fast", iterations=6, substeps=2, large_level=0,
+                       sleep_time=0.25),
+    "balanced": Preset("balanced"),
+    "accurate": Preset("accurate", iterations=20, collision_slop=0.05,
+                       substeps=8, large_level=None),
+}
+DEFAULT_PRESET = "balanced"
+
+def load_preset(path):
+    """
+    Reads a preset file, JSON with any of a Preset's settings and the name
+    of a "preset" to take the rest from, balanced by default
+    """
+    with open(path) as preset_file:
+        data = json.load(preset_file)
+
+    base = data.pop("preset", DEFAULT_PRESET)
+    if base not in PRESETS:
+        raise ValueError("{0}: no preset called '{1}'".format(path, base))
+    settings = PRESETS[base].settings()
+    for setting in data:
+        if setting not in settings:
+            raise ValueError("{0}: unknown setting '{1}'".format(path,
+                                                                  setting))
+    settings.update(data)
+    return Preset(os.path.splitext(os.path.basename(path))[0], **settings)
+
+def find_preset(name):
+    """
+    Returns the preset called name, or read from the file name if there is
+    no preset called that
+    """
+    if name in PRESETS:
+        return PRESETS[name]
+    if os.path.exists(name):
+        return load_preset(name)
+    raise ValueError("no preset or preset file called '{0}', the presets "
+                     "are {1}".format(name, ", ".join(sorted(PRESETS))))
+
+# The trajectory preview predicts the ball's path for ramp heights rounded
+# to PREVIEW_QUANTUM, up to PREVIEW_TICKS ticks ahead, spending at most
+# PREVIEW_BUDGET seconds a frame simulating
+PREVIEW_QUANTUM = 5
+PREVIEW_TICKS   = 90
+PREVIEW_BUDGET  = 0.0015
+SETTLE_TICKS    = 15   # Ticks a new ball takes to settle in the ball area
+
+# Collision types, the World's handlers are registered between these
+BALL_TYPE   = 1
+CRATE_TYPE  = 2
+TNT_TYPE    = 3
+SNAKE_TYPE  = 4
+GROUND_TYPE = 5
+PUDDLE_TYPE = 6
+
+# The pairs of collision types the World has handlers for
+HANDLERS = ((CRATE_TYPE, BALL_TYPE), (TNT_TYPE, BALL_TYPE),
+            (SNAKE_TYPE, GROUND_TYPE), (SNAKE_TYPE, PUDDLE_TYPE))
+
+LEVEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "levels")
+
+def load_level(path):
+    """
+    Reads a level file. Levels are JSON with lists of [x, y] positions for
+    "crates", "tnt" and "snakes", the "ground" height and "width", a "timer"
+    in seconds (or null) and the indices of "crates" drawn as "broken" ones.
+    A "map" of the level drawn in ASCII can be kept alongside for reference
+    """
+    with open(path) as level_file:
+        data = json.load(level_file)
+
+    for key in ("crates", "snakes"):
+        if key not in data:
+            raise ValueError("{0}: level has no '{1}'".format(path, key))
+    data.setdefault("tnt", [])
+    data.setdefault("broken", [])
+    data.setdefault("timer", None)
+    data.setdefault("ground", GROUND)
+    data.setdefault("width", GROUND_WIDTH)
+    data.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    return data
+
+def load_levels(directory=LEVEL_DIR):
+    """
+    Reads every levelN.json file in a directory, in order of N
+    """
+    names = [name for name in os.listdir(directory)
+             if name.startswith("level") and name.endswith(".json")]
+    names.sort(key=lambda name: int(name[len("level"):-len(".json")]))
+    return [load_level(os.path.join(directory, name)) for name in names]
+
+LEVELS = load_levels()
+
+# Moments only depend on the mass and shape, so every crate of a kind
+# shares one
+_moments = {}
+
+def moment_for_poly(mass, points):
+    """
+    Returns pymunk's moment for a polygon, computing it once per mass and
+    set of points
+    """
+    key = (mass, tuple(points))
+    moment = _moments.get(key)
+    if moment is None:
+        moment = pm.moment_for_poly(mass, points, (0,0))
+        _moments[key] = moment
+    return moment
+
+# pymunk's collision handlers are closures over their space, which puts
+# every space with handlers in a reference cycle. The cyclic garbage
+# collector frees what is in a cycle in any order, so it can free the
+# bodies before the space, and Chipmunk then walks the freed bodies as it
+# frees the space. Handlers are only ever given weak references to their
+# World, and a World empties its space and takes the handlers out before
+# letting go of it, in new_space() and close(), so spaces are freed as
+# soon as they are let go of
+def weak_handler(method):
+    """
+    Returns a collision handler calling a bound method, without keeping
+    the method's object alive
+    """
+    method = weakref.WeakMethod(method)
+    def handler(space, arbiter):
+        return method()(space, arbiter)
+    return handler
+
+class Entity:
+    """
+    Base for the balls, crates and snakes, each is one pymunk body with
+    one shape. The body's previous position and angle can be kept so
+    drawing can interpolate between physics steps
+    """
+
+    shape = None
+    previous = None
+
+    def objects(self):
+        """
+        Returns the entity's pymunk body and shape
+        """
+        return [self.shape.body, self.shape]
+
+    def delete(self, space):
+        """
+        Removes occurences of the entity from pymunk's space
+        """
+        space.remove(self.shape)
+        space.remove(self.shape.body)
+
+    def use_shape(self, shape, position):
+        """
+        Takes over a shape and its body from another entity of the same
+        shape type, making them this entity's at position
+        """
+        body = shape.body
+        # Every entity of a collision type and mass has the same points,
+        # so a shape from another of the same kind is used as it is
+        if (shape.collision_type != self.collision_type or
+                body.mass != self.mass):
+            shape.unsafe_set_vertices(self.points)
+            shape.collision_type = self.collision_type
+            body.mass = self.mass
+            body.moment = moment_for_poly(int(self.mass), self.points)
+        chipmunk.reset_body(body, position)
+        self.shape = shape
+        self.previous = None
+
+    def state(self):
+        """
+        Returns the entity's state, for a Snapshot
+        """
+        return {"body": chipmunk.body_state(self.shape.body),
+                "id": chipmunk.shape_id(self.shape)}
+
+    def restore(self, state):
+        """
+        Puts the entity back in a state returned by state(), the shape
+        must not be in a space
+        """
+        chipmunk.set_body_state(self.shape.body, state["body"])
+        chipmunk.set_shape_id(self.shape, state["id"])
+        self.previous = None
+
+    def store_previous(self):
+        """
+        Keeps the body's position and angle from before a physics step
+        """
+        body = self.shape.body
+        # pymunk's position is a view onto the body, so copy it
+        self.previous = (tuple(body.position), body.angle)
+
+    def interpolated(self, alpha):
+        """
+        Returns the position and angle alpha of the way between the
+        previous physics step and the current one
+        """
+        body = self.shape.body
+        position, angle = body.position, body.angle
+        if self.previous is None:
+            return position, angle
+        (x, y), previous_angle = self.previous
+        return ((x + (position[0] - x) * alpha,
+                 y + (position[1] - y) * alpha),
+                previous_angle + (angle - previous_angle) * alpha)
+
+class Ball(Entity):
+    """
+    Provides a ball for the player to fire from the trebuchet
+    """
+
+    def __init__(self, space, x, y, kind=0):
+        """
+        Sets up pymunk properties for the Ball, its mass and radius are
+        those of its kind in PROJECTILES
+        """
+        name, mass, radius = PROJECTILES[kind]
+        self.kind = kind
+        self.idle_ticks = 0
+        inertia = pm.moment_for_circle(mass, 0, radius, (0,0))
+        body = pm.Body(mass, inertia)
+        body.position = (x,y)
+        shape = pm.Circle(body, radius, (0,0))
+        shape.friction = 15.0
+        shape.elasticity = 0.9
+        shape.collision_type = BALL_TYPE
+        # Chipmunk orders two colliding circles by where they are in
+        # memory, so balls hitting each other would play out differently
+        # from run to run. They share a group, so never do
+        shape.group = BALL_GROUP
+        if space is not None:
+            space.add(body, shape)
+        self.ball = shape
+        self.shape = shape
+
+    def fire(self, force):
+        """
+        Applys an impulse to the ball object
+        """
+        self.ball.body.activate()
+        pm.Body.apply_impulse(self.ball.body, (force,0))
+
+    def get_position(self):
+        """
+        Returns the Ball's coordinates
+        """
+        return self.ball.body.position
+
+    def reposition(self, x, y):
+        """
+        Allows user to move the ball to a specified location
+        """
+        self.ball.body.activate()
+        self.ball.body.position = (x,y)
+        self.previous = None
+
+    def reset(self, position):
+        """
+        Puts the Ball back at rest at a position, so it can be fired again
+        """
+        chipmunk.reset_body(self.ball.body, position)
+        self.previous = None
+        self.idle_ticks = 0
+
+    def at_rest(self):
+        """
+        Counts the ticks the ball has been still for, returns whether that
+        is REST_TICKS or more, or it is asleep
+        """
+        body = self.ball.body
+        if body.is_sleeping:
+            return True
+        if body.velocity.get_length_sqrd() < IDLE_SPEED ** 2:
+            self.idle_ticks += 1
+        else:
+            self.idle_ticks = 0
+        return self.idle_ticks >= REST_TICKS
+
+    def state(self):
+        """
+        Returns the ball's state, for a Snapshot
+        """
+        state = super().state()
+        state["idle_ticks"] = self.idle_ticks
+        return state
+
+    def restore(self, state):
+        """
+        Puts the ball back in a state returned by state()
+        """
+        super().restore(state)
+        self.idle_ticks = state["idle_ticks"]
+
+
+class Crate(Entity):
+    """
+    Provides a crate object for building structure in the game_complete
+    Can be a small crate or larger TNT crate by supplying an optional
+    paramter to the contructor
+    """
+
+    def __init__(self, space, starting_position, is_tnt=False, mass=6.0):
+        """
+        Sets up pymunk properties for the Crate
+        Decides whether a normal or TNT crate was requested
+        """
+        self.is_tnt = is_tnt
+        if is_tnt:
+            points = [(-46, -46), (-46, 46), (46,46), (46, -46)]
+        else:
+            points = [(-23, -23), (-23, 23), (23,23), (23, -23)]
+        self.points = points
+        self.mass = mass
+        self.collision_type = TNT_TYPE if is_tnt else CRATE_TYPE
+
+        moment = moment_for_poly(int(mass), points)
+        body = pm.Body(mass, moment)
+        body.position = starting_position
+        shape = pm.Poly(body, points, (0,0))
+        shape.friction = 1
+        shape.collision_type = self.collision_type
+        if space is not None:
+            space.add(body,shape)
+        self.shape = shape
+        self.run_count = 0
+        self.broken = None
+        self.exploded = False
+
+    @property
+    def crate(self):
+        """
+        The crate's pymunk shape
+        """
+        return self.shape
+
+    def brake_crate(self, rng=random):
+        """
+        Marks the crate as a 'broken' style crate, picking one of the two
+        styles at random with rng. Only for use with smaller crates
+        """
+        self.run_count += 1
+        if self.run_count == 1:
+            num = rng.randint(1,2)
+
+            if not self.is_tnt:
+                self.broken = num
+
+    def objects(self):
+        """
+        Returns the crate's pymunk body and shape, or nothing once it has
+        exploded and left the space
+        """
+        if self.exploded:
+            return []
+        return super().objects()
+
+    def explode(self, space):
+        """
+        Takes an exploded TNT crate out of pymunk's space, it stays one of
+        the level's crates so a snapshot can bring it back
+        """
+        self.delete(space)
+        self.exploded = True
+
+    def reset(self, starting_position):
+        """
+        Puts the Crate back to how it was built at a new position,
+        so it can be reused by another level
+        """
+        chipmunk.reset_body(self.crate.body, starting_position)
+        self.previous = None
+        self.run_count = 0
+        self.broken = None
+        self.exploded = False
+
+    def state(self):
+        """
+        Returns the crate's state, for a Snapshot
+        """
+        state = super().state()
+        state["broken"] = self.broken
+        state["run_count"] = self.run_count
+        state["exploded"] = self.exploded
+        return state
+
+    def restore(self, state):
+        """
+        Puts the crate back in a state returned by state()
+        """
+        super().restore(state)
+        self.broken = state["broken"]
+        self.run_count = state["run_count"]
+        self.exploded = state["exploded"]
+
+
+class Snake(Entity):
+    """
+    Provides a Snake character as the player's enemy
+    """
+
+    already_killed_snake = False
+
+    def __init__(self, space, starting_position, mass=1.0):
+        """
+        Sets up pymunk properties for the Snake
+        """
+        points = [(-40, -40), (-40, 40), (40,40), (40, -40)]
+        self.points = points
+        self.mass = mass
+        self.collision_type = SNAKE_TYPE
+
+        moment = moment_for_poly(int(mass), points)
+        body = pm.Body(mass, moment)
+        body.position = starting_position
+        shape = pm.Poly(body, points, (0,0))
+        shape.friction = 1
+        shape.collision_type = SNAKE_TYPE
+        if space is not None:
+            space.add(body,shape)
+        self.shape = shape
+
+    @property
+    def snake(self):
+        """
+        The snake's pymunk shape
+        """
+        return self.shape
+
+    def kill_snake(self):
+        """
+        Marks the Snake as dead
+        """
+        self.already_killed_snake = True
+
+    def reset(self, starting_position):
+        """
+        Puts the Snake back to how it was built at a new position,
+        so it can be reused by another level
+        """
+        chipmunk.reset_body(self.snake.body, starting_position)
+        self.previous = None
+        self.already_killed_snake = False
+
+    def state(self):
+        """
+        Returns the snake's state, for a Snapshot
+        """
+        state = super().state()
+        state["dead"] = self.already_killed_snake
+        return state
+
+    def restore(self, state):
+        """
+        Puts the snake back in a state returned by state(). The count of
+        snakes alive is the World's to restore
+        """
+        super().restore(state)
+        self.already_killed_snake = state["dead"]
+
+class Ramp:
+    """
+    Provides the ramp the ball is launched from, its end follows the mouse.
+    A single segment is kept in pymunk's space and moved in place, so the
+    number of shapes in the space stays constant
+    """
+
+    def __init__(self, space, body, start=(60,110), rampsize=RAMPSIZE):
+        """
+        Sets up the pymunk segment for the Ramp
+        """
+        self.start = start
+        self.end = (250, rampsize)
+        shape = pm.Segment(body, self.start, self.end, .0)
+        space.add(shape)
+        self.ramp = shape
+        self.space = space
+
+    def move(self, rampsize):
+        """
+        Moves the end of the ramp to the given height, the segment is
+        only reindexed when the end point has actually changed
+        """
+        end = (250, rampsize)
+        if end != self.end:
+            self.end = end
+            self.ramp.unsafe_set_b(end)
+            self.space.reindex_shape(self.ramp)
+
+    def delete(self, space):
+        """
+        Removes the Ramp from pymunk's space
+        """
+        space.remove(self.ramp)
+
+class Snapshot:
+    """
+    A World's level as it was at one moment: every ball, crate and snake
+    and its state, the snakes left alive, the ramp, the World's random and
+    clock. Taken by World.snapshot and put back by World.restore, which
+    only accepts snapshots of the level it has loaded now
+    """
+
+    def __init__(self, world):
+        """
+        Takes a snapshot of the world
+        """
+        self.space = world.space
+        self.balls = list(world.balls)
+        self.crates = list(world.crates)
+        self.snakes = list(world.snakes)
+        self.states = [entity.state() for entity in
+                       self.balls + self.crates + self.snakes]
+        self.snakes_alive = world.snakes_alive
+        self.rampsize = world.ramp.end[1]
+        self.random = world.random.getstate()
+        self.shape_ids = world.shape_ids
+        self.frames = world.frames
+        self.elapsed = world.elapsed
+
+class World:
+    """
+    The pymunk space with the level's static scenery, the ramp and the
+    balls, crates and snakes of the current level.
+    Subclasses can swap in their own entity classes, the game uses this
+    to add drawing to them
+    """
+
+    ball_class  = Ball
+    crate_class = Crate
+    snake_class = Snake
+    ramp_class  = Ramp
+
+    def __init__(self, substeps=None, interpolate=False, large=None,
+                 preset=None):
+        """
+        Sets up the space and the scenery every level shares.
+        The physics settings come from a Preset, balanced by default.
+        Each tick of STEP seconds is split into substeps physics steps,
+        the preset's by default, 4 substeps gives 120 Hz physics. With
+        interpolate set, bodies' positions before each tick are kept for
+        interpolated drawing. large turns large level mode on or off for
+        every level, by default it is used for levels of the preset's
+        large_level entities or more
+        """
+        self.preset = preset or PRESETS[DEFAULT_PRESET]
+        self.balls = []
+        self.crates = []
+        self.snakes = []
+        self.snakes_alive = 0
+        self.substeps = substeps or self.preset.substeps
+        self.interpolate = interpolate
+        self.large = large
+        self.is_large = False
+        self.spare_crates = {False: [], True: []}
+        self.spare_snakes = []
+        self.spare_balls = {}     # kind -> balls out of play
+        self.random = random.Random(0)
+        self.seed = 0
+        self.data = {}
+        self.level = None
+        self.start = None    # Snapshot of the level as it was loaded
+        self.frames = 0
+        self.elapsed = 0.0
+        self.space = None
+        self.new_space()
+
+    def new_space(self, height=GROUND, width=GROUND_WIDTH):
+        """
+        Makes a new space with the scenery and the ramp in it, the ground
+        at height and width long. Every level gets a fresh space, so how
+        it plays out doesn't depend on the levels played before it.
+        The ground starts where the level wants it, as moving it after the
+        ramp is indexed would leave Chipmunk's index of the scenery
+        different from how a restored level finds it
+        """
+        self.free_space()
+        # The scenery always takes the first shape ids
+        pm.reset_shapeid_counter()
+        space = pm.Space()
+        space.gravity = (0.0, -300.0)
+        self.preset.apply(space)
+        body = pm.Body()
+
+        # ground
+        ground = pm.Segment(body, (0,height), (width, height), .0)
+        ground.friction = 6.0
+        ground.collision_type = GROUND_TYPE
+        space.add(ground)
+
+        # toxic puddle, a sensor along the ground that kills snakes.
+        # It reaches well past the ends of the ground, so snakes knocked
+        # off the edge of the world die as they fall through it
+        puddle_height = height + PUDDLE_DEPTH / 2.0
+        puddle = pm.Segment(body, (-PUDDLE_REACH, puddle_height),
+                            (PUDDLE_REACH, puddle_height), PUDDLE_DEPTH / 2.0)
+        puddle.sensor = True
+        puddle.collision_type = PUDDLE_TYPE
+        space.add(puddle)
+
+        #left wall
+        left_wall = pm.Segment(body, (0,600), (0,-1400), .0)
+        left_wall.friction = 6.0
+        space.add(left_wall)
+
+        # ball area
+        ball_area = pm.Segment(body, (0,110), (60,110), .0)
+        space.add(ball_area)
+
+        self.space = space
+        self.static_body = body
+        self.ground = ground
+        self.puddle = puddle
+        self.entities = {}   # shape -> ball, crate or snake
+        self.killed = []     # snakes killed during this tick
+        self.lit = []        # TNT to go off at the end of this step
+        self.add_handlers()
+        self.ramp = self.ramp_class(space, body, (60,110), RAMPSIZE)
+        self.shape_ids = len(space.shapes)
+
+    def close(self):
+        """
+        Frees the space of a World that is done with, the World can't be
+        used after. Never called from a finalizer, as by then the garbage
+        collector may already have freed the space's bodies and shapes
+        """
+        self.free_space()
+
+    def free_space(self):
+        """
+        Takes everything out of the space and removes its collision
+        handlers, so it is freed as soon as it is let go of rather than
+        by the cyclic garbage collector, see weak_handler
+        """
+        space = self.space
+        if space is None:
+            return
+        space.remove(*space.constraints)
+        space.remove(*space.shapes)
+        space.remove(*space.bodies)
+        for a, b in HANDLERS:
+            space.remove_collision_handler(a, b)
+        self.space = None
+
+    def build_level(self, level, seed=0):
+        """
+        Removes any old level from the space and sets up the level with
+        the given index in LEVELS
+        """
+        self.load(LEVELS[level], seed)
+        self.level = level
+
+    def load(self, data, seed=0):
+        """
+        Removes any old level from the space and sets up the one described
+        by data, as returned by load_level. Every body and shape is created
+        first and then added to the space in one go.
+        Everything random in the level comes from the World's random,
+        seeded with seed, so a level played with the same inputs plays out
+        the same every time
+        """
+        self.clear()
+        ground = data.get("ground", GROUND)
+        self.new_space(ground, data.get("width", GROUND_WIDTH))
+        self.random.seed(seed)
+        self.seed = seed
+
+        self.balls = [self.make_ball(0)]
+        self.crates = [self.make_crate(tuple(position), False)
+                       for position in data["crates"]]
+        self.crates += [self.make_crate(tuple(position), True)
+                        for position in data.get("tnt", [])]
+        self.snakes = [self.make_snake(tuple(position))
+                       for position in data["snakes"]]
+        self.snakes_alive = len(self.snakes)
+
+        if self.large is None:
+            entities = len(self.crates) + len(self.snakes)
+            large_level = self.preset.large_level
+            self.set_large(large_level is not None and
+                           entities >= large_level)
+        else:
+            self.set_large(self.large)
+
+        self.order_shapes(self.crates + self.snakes)
+        objs = []
+        for entity in self.balls + self.crates + self.snakes:
+            self.number_shape(entity.shape)
+            objs += entity.objects()
+            self.entities[entity.shape] = entity
+        self.space.add(*objs)
+
+        # Add variety to crate's looks
+        for index in data.get("broken", []):
+            self.crates[index].brake_crate(self.random)
+
+        self.data = data
+        self.level = None
+        self.frames = 0
+        self.elapsed = 0.0
+        self.start = self.snapshot()
+
+    def snapshot(self):
+        """
+        Returns a Snapshot of the level as it is now
+        """
+        return Snapshot(self)
+
+    def restore(self, snapshot):
+        """
+        Puts the level back as it was when snapshot was taken, in place:
+        the same bodies and shapes have their state copied straight back
+        into Chipmunk. A level restored to a snapshot taken as it was
+        loaded plays out exactly as the freshly loaded level does. Later
+        snapshots lose the contact impulses Chipmunk keeps between steps,
+        so play out closely but not bit for bit the same
+        """
+        if snapshot.space is not self.space:
+            raise ValueError("snapshot is of another level")
+
+        # Taking the bodies and shapes out and adding them again in the
+        # same order is the only way to empty Chipmunk's contact cache and
+        # rebuild its index as a loaded level has them. Left in, the
+        # restored level plays out differently from its first step
+        objs = []
+        for entity in self.balls + self.crates + self.snakes:
+            objs += entity.objects()
+        self.space.remove(*objs)
+        self.entities.clear()
+
+        # Balls fired since the snapshot go spare, and balls in it that
+        # went spare come back into play
+        for ball in self.balls:
+            if ball not in snapshot.balls:
+                self.spare_balls.setdefault(ball.kind, []).append(ball)
+        for ball in snapshot.balls:
+            spare = self.spare_balls.get(ball.kind, [])
+            if ball in spare:
+                spare.remove(ball)
+
+        # The ramp is indexed before the entities, as in a loaded level
+        self.ramp.move(snapshot.rampsize)
+        self.balls = list(snapshot.balls)
+        self.crates = list(snapshot.crates)
+        self.snakes = list(snapshot.snakes)
+        objs = []
+        for entity, state in zip(self.balls + self.crates + self.snakes,
+                                 snapshot.states):
+            entity.restore(state)
+            objs += entity.objects()
+            self.entities[entity.shape] = entity
+        self.space.add(*objs)
+
+        self.snakes_alive = snapshot.snakes_alive
+        self.random.setstate(snapshot.random)
+        self.shape_ids = snapshot.shape_ids
+        self.frames = snapshot.frames
+        self.elapsed = snapshot.elapsed
+        self.killed = []
+        self.lit = []
+
+    def retry(self):
+        """
+        Puts the level back as it was when it was loaded, for another try
+        """
+        self.restore(self.start)
+
+    def order_shapes(self, entities):
+        """
+        Hands the entities' shapes back out in the order they are in
+        memory, so the first entity always has the lowest address
+        """
+        shapes = sorted((entity.shape for entity in entities),
+                        key=chipmunk.shape_address)
+        # Only entities whose shape is another's swap, and pymunk's
+        # positions are views onto the bodies, so copy them first
+        swaps = [(entity, shape, tuple(entity.shape.body.position))
+                 for entity, shape in zip(entities, shapes)
+                 if shape is not entity.shape]
+        for entity, shape, position in swaps:
+            entity.use_shape(shape, position)
+
+    def number_shape(self, shape):
+        """
+        Gives a shape that is about to go in the space the next shape id
+        """
+        chipmunk.set_shape_id(shape, self.shape_ids)
+        self.shape_ids += 1
+
+    def make_crate(self, position, is_tnt):
+        """
+        Returns a crate at position, reusing one from an old level if
+        there is one spare
+        """
+        spare = self.spare_crates[is_tnt]
+        if spare:
+            crate = spare.pop()
+            crate.reset(position)
+            return crate
+        return self.crate_class(None, position, is_tnt)
+
+    def make_ball(self, kind):
+        """
+        Returns a ball of a kind at BALL_HOME, reusing one out of play if
+        there is one spare
+        """
+        spare = self.spare_balls.get(kind)
+        if spare:
+            ball = spare.pop()
+            ball.reset(BALL_HOME)
+            return ball
+        return self.ball_class(None, BALL_HOME[0], BALL_HOME[1], kind)
+
+    def make_snake(self, position):
+        """
+        Returns a snake at position, reusing one from an old level if
+        there is one spare
+        """
+        if self.spare_snakes:
+            snake = self.spare_snakes.pop()
+            snake.reset(position)
+            return snake
+        return self.snake_class(None, position)
+
+    def set_large(self, large):
+        """
+        Turns large level mode on or off. Bodies that have been idle for
+        the preset's sleep_time fall asleep and aren't stepped until
+        something wakes them, and the space indexes its shapes in a
+        spatial hash of the preset's cell size instead of Chipmunk's
+        default tree. pymunk 4 has no method for the hash, so Chipmunk's
+        is called directly. The space keeps its spatial hash once it has
+        one, each level gets a fresh space anyway
+        """
+        space = self.space
+        if large:
+            space.sleep_time_threshold = self.preset.sleep_time
+            space.idle_speed_threshold = IDLE_SPEED
+            cells = max(1000, 10 * (len(self.crates) + len(self.snakes)))
+            chipmunk.use_spatial_hash(space, self.preset.hash_cell, cells)
+        else:
+            space.sleep_time_threshold = float("inf")
+            space.idle_speed_threshold = 0
+        self.is_large = large
+
+    def sleeping(self):
+        """
+        Returns how many of the balls, crates and snakes are asleep
+        """
+        return sum(1 for entity in self.balls + self.crates + self.snakes
+                   if entity.shape.body.is_sleeping)
+
+    def move_ground(self, height, width=GROUND_WIDTH):
+        """
+        Moves the ground and the puddle on it to the given height and makes
+        the ground width long, if they aren't like that already
+        """
+        if self.ground.a[1] != height or self.ground.b[0] != width:
+            self.ground.unsafe_set_a((0, height))
+            self.ground.unsafe_set_b((width, height))
+            self.space.reindex_shape(self.ground)
+            puddle_height = height + PUDDLE_DEPTH / 2.0
+            self.puddle.unsafe_set_a((-PUDDLE_REACH, puddle_height))
+            self.puddle.unsafe_set_b((PUDDLE_REACH, puddle_height))
+            self.space.reindex_shape(self.puddle)
+
+    def add_handlers(self):
+        """
+        Registers the collision handlers that apply the game's rules, so
+        the work done each step depends on what collides rather than on
+        how many entities there are
+        """
+        space = self.space
+        # Only the ball breaks crates. Stacked crates touch each other and
+        # the ground every step, and a Python callback for each of those
+        # contacts would cost more than the polling this replaces
+        for crate_type in (CRATE_TYPE, TNT_TYPE):
+            space.add_collision_handler(
+                crate_type, BALL_TYPE,
+                post_solve=weak_handler(self.crate_hit))
+        for ground_type in (GROUND_TYPE, PUDDLE_TYPE):
+            space.add_collision_handler(
+                SNAKE_TYPE, ground_type,
+                begin=weak_handler(self.snake_landed))
+
+    def crate_hit(self, space, arbiter):
+        """
+        Post-solve handler, breaks a crate or lights TNT hit hard enough
+        """
+        impulse = arbiter.total_impulse.get_length()
+        crate = self.entities.get(arbiter.shapes[0])
+        if crate is None:
+            return
+        if crate.is_tnt:
+            if impulse > TNT_IMPULSE:
+                self.light(crate)
+        elif impulse > BREAK_IMPULSE and crate.broken is None:
+            crate.brake_crate(self.random)
+
+    def light(self, crate):
+        """
+        Sets a TNT crate to go off at the end of the physics step. All the
+        TNT lit during a step, and every crate it sets off in turn, goes
+        off in one post-step callback
+        """
+        if crate.exploded or crate in self.lit:
+            return
+        if not self.lit:
+            self.space.add_post_step_callback(self.explode, "explode")
+        self.lit.append(crate)
+
+    def explode(self, key):
+        """
+        Post-step callback, sets off the TNT lit during the step. Blasts
+        that light more TNT add it to the end of the list being gone
+        through, so a whole chain reaction happens in the one step
+        """
+        for crate in self.lit:
+            self.blast(crate)
+        self.lit = []
+
+    def blast(self, tnt):
+        """
+        Takes an exploding TNT crate out of the space and pushes away the
+        bodies around it, breaking crates and lighting TNT pushed hard
+        enough. Only the shapes a bounding box query finds near the blast
+        are looked at, however many crates the level has
+        """
+        x, y = tnt.shape.body.position
+        tnt.explode(self.space)
+        self.entities.pop(tnt.shape, None)
+
+        area = pm.BB(x - BLAST_RADIUS, y - BLAST_RADIUS,
+                     x + BLAST_RADIUS, y + BLAST_RADIUS)
+        for shape in self.space.bb_query(area):
+            entity = self.entities.get(shape)
+            if entity is None:
+                continue
+            body = shape.body
+            dx = body.position[0] - x
+            dy = body.position[1] - y
+            distance = math.hypot(dx, dy)
+            if distance >= BLAST_RADIUS or distance == 0:
+                continue
+            impulse = BLAST_IMPULSE * (1 - distance / BLAST_RADIUS)
+            body.activate()
+            body.apply_impulse((dx / distance * impulse,
+                                dy / distance * impulse))
+
+            if not isinstance(entity, Crate):
+                continue
+            if entity.is_tnt:
+                if impulse > TNT_IMPULSE:
+                    self.light(entity)
+            elif impulse > BREAK_IMPULSE and entity.broken is None:
+                entity.brake_crate(self.random)
+
+    def exploded(self):
+        """
+        Returns how many of the level's TNT crates have gone off
+        """
+        return sum(1 for crate in self.crates if crate.exploded)
+
+    def snake_landed(self, space, arbiter):
+        """
+        Begin handler, a snake touching the ground or the toxic puddle dies
+        """
+        snake = self.entities.get(arbiter.shapes[0])
+        if snake is not None and not snake.already_killed_snake:
+            snake.kill_snake()
+            self.snakes_alive -= 1
+            self.killed.append(snake)
+        return True
+
+    def clear(self):
+        """
+        Removes every ball, crate and snake from the space in one go,
+        keeping the crates and snakes spare for the next level
+        """
+        objs = []
+        for entity in self.balls + self.crates + self.snakes:
+            objs += entity.objects()
+        if objs:
+            self.space.remove(*objs)
+        # Spares are taken from the end, so keep them last to first, and
+        # the same level loaded again gets its shapes back in order
+        for crate in reversed(self.crates):
+            self.spare_crates[crate.is_tnt].append(crate)
+        self.spare_snakes += reversed(self.snakes)
+        for ball in self.balls:
+            self.spare_balls.setdefault(ball.kind, []).append(ball)
+        self.entities.clear()
+        self.balls = []
+        self.crates = []
+        self.snakes = []
+
+    def timer(self):
+        """
+        Returns the level's time limit in seconds, or None
+        """
+        return self.data.get("timer")
+
+    def time_left(self):
+        """
+        Returns the whole seconds left of the level's time limit, or None
+        if it has none. The clock is the physics time, so it runs the same
+        however fast the level is played
+        """
+        if not self.timer():
+            return None
+        return self.timer() - int(self.time())
+
+    def won(self):
+        """
+        Returns whether every snake on the level is dead
+        """
+        return self.snakes_alive == 0
+
+    def failed(self):
+        """
+        Returns whether the level's time ran out with snakes still alive
+        """
+        time_left = self.time_left()
+        return time_left is not None and time_left <= 0 and not self.won()
+
+    def ball(self):
+        """
+        Returns the newest ball, the one firing pushes
+        """
+        return self.balls[-1]
+
+    def reset_ball(self, kind=0):
+        """
+        Puts a fresh ball of a kind in the ball area, returns it. Balls
+        already fired stay in play until they go off screen or come to
+        rest, one still waiting in the ball area is swapped for the new
+        one, and the oldest is taken out if there are MAX_BALLS
+        """
+        if self.balls:
+            ball = self.ball()
+            if ball.get_position()[0] < self.ramp.start[0]:
+                self.remove_ball(ball)
+        if len(self.balls) >= MAX_BALLS:
+            self.remove_ball(self.balls[0])
+
+        ball = self.make_ball(kind)
+        self.number_shape(ball.shape)
+        self.space.add(*ball.objects())
+        self.balls.append(ball)
+        self.entities[ball.shape] = ball
+        return ball
+
+    def remove_ball(self, ball):
+        """
+        Takes a ball out of play, keeping it spare
+        """
+        ball.delete(self.space)
+        self.entities.pop(ball.shape, None)
+        self.balls.remove(ball)
+        self.spare_balls.setdefault(ball.kind, []).append(ball)
+
+    def fire(self, force=FORCE/3):
+        """
+        Pushes the newest ball, the game does this every frame the mouse
+        button is held
+        """
+        self.ball().fire(force)
+
+    def tick(self, rampsize, fire=False, reset=False, force=FORCE/3,
+             kind=0):
+        """
+        Applies one tick's inputs then steps the physics, returns the
+        snakes killed. reset puts a fresh ball of a kind in the ball area
+        first. Everything the player does goes through here, so recording
+        these arguments is enough to replay a level
+        """
+        if reset:
+            self.reset_ball(kind)
+        self.ramp.move(rampsize)
+        if fire:
+            self.fire(force)
+        return self.step()
+
+    def interpolated_entities(self):
+        """
+        Returns the entities whose previous positions step() keeps for
+        interpolated drawing
+        """
+        return self.balls + self.crates + self.snakes
+
+    def step(self, dt=STEP):
+        """
+        Steps the physics on by one tick and applies the game's rules,
+        returns the snakes killed during the tick
+        """
+        if self.interpolate:
+            for entity in self.interpolated_entities():
+                entity.store_previous()
+
+        substep = dt / self.substeps
+        for i in range(self.substeps):
+            self.space.step(substep)
+        self.frames += 1
+        self.elapsed += dt
+
+        # Snakes are killed by the collision handlers during the steps
+        killed = self.killed
+        self.killed = []
+
+        # If the newest ball goes off screen to the right, bring it back.
+        # Older ones are taken out once off screen or at rest, so the
+        # number of bodies stays flat however many are fired
+        for ball in self.balls[:-1]:
+            x, y = ball.get_position()
+            if x > 1024 or y < 0 or ball.at_rest():
+                self.remove_ball(ball)
+        if self.balls and self.ball().get_position()[0] > 1024:
+            self.ball().reposition(1,110)
+
+        return killed
+
+    def time(self):
+        """
+        Returns the physics time the level has been running, in seconds
+        """
+        return self.elapsed
+
+    def snakes_killed(self):
+        """
+        Returns how many of the level's snakes are dead
+        """
+        return sum(1 for snake in self.snakes if snake.already_killed_snake)
+
+    def body_positions(self):
+        """
+        Returns (kind, x, y, angle) for every ball, crate and snake
+        """
+        positions = []
+        for kind, shapes in (("ball", [b.ball for b in self.balls]),
+                             ("crate", [c.crate for c in self.crates]),
+                             ("snake", [s.snake for s in self.snakes])):
+            for shape in shapes:
+                body = shape.body
+                positions.append((kind, body.position[0], body.position[1],
+                                  body.angle))
+        return positions
+
+class Trajectory:
+    """
+    Predicts the path of the ball off the ramp, by firing it in a World of
+    its own that has only the scenery, the ramp and the ball. The ball is
+    fired every tick it is on the ramp, as if the button is held until it
+    leaves. Paths are cached per kind of ball and ramp height rounded to
+    PREVIEW_QUANTUM, and one being simulated is carried on over as many
+    frames as it takes to stay within budget seconds a frame
+    """
+
+    def __init__(self, force=FORCE/3, substeps=None,
+                 budget=PREVIEW_BUDGET, preset=None):
+        """
+        Initialise the Trajectory, its world has the same substeps and
+        preset as the game's should
+        """
+        self.world = World(substeps, preset=preset)
+        self.ball = self.world.reset_ball()
+        self.force = force
+        self.budget = budget
+        self.paths = {}          # (kind, rounded ramp height) -> [(x, y)]
+        self.pending = None      # (kind and ramp height, path) simulating
+        self.homes = {}          # kind -> where its ball rests, ready
+        self.ground = None
+        self.set_ground(GROUND, GROUND_WIDTH)
+
+    def close(self):
+        """
+        Frees the Trajectory's world
+        """
+        self.world.close()
+
+    def set_ground(self, height, width=GROUND_WIDTH):
+        """
+        Moves the ground to match a level's, forgetting the cached paths
+        if it has moved
+        """
+        if (height, width) == self.ground:
+            return
+        self.ground = (height, width)
+        self.paths = {}
+        self.pending = None
+        self.homes = {}
+        self.world.move_ground(height, width)
+
+    def home(self, kind):
+        """
+        Puts a ball of a kind where it comes to rest in the ball area,
+        which is where its paths start from
+        """
+        if kind != self.ball.kind:
+            self.world.remove_ball(self.ball)
+            self.ball = self.world.reset_ball(kind)
+        home = self.homes.get(kind)
+        if home is None:
+            self.ball.reset(BALL_HOME)
+            for tick in range(SETTLE_TICKS):
+                self.world.step()
+            home = self.homes[kind] = tuple(self.ball.get_position())
+        self.ball.reset(home)
+
+    def level(self, data):
+        """
+        Sets the ground up for a level, as returned by load_level
+        """
+        self.set_ground(data.get("ground", GROUND),
+                        data.get("width", GROUND_WIDTH))
+
+    def path(self, rampsize, kind=0):
+        """
+        Returns the predicted path of a kind of ball for a ramp height, as
+        (x, y) per tick. A path still being simulated is returned as far
+        as it has got
+        """
+        rampsize = (int(round(rampsize / float(PREVIEW_QUANTUM))) *
+                    PREVIEW_QUANTUM)
+        key = (kind, rampsize)
+        path = self.paths.get(key)
+        if path is not None:
+            return path
+        if self.pending is None or self.pending[0] != key:
+            self.home(kind)
+            self.world.ramp.move(rampsize)
+            self.pending = (key, [])
+        return self.simulate()
+
+    def simulate(self):
+        """
+        Carries on simulating the pending path until it is finished or the
+        frame's budget is spent, returns the path so far
+        """
+        key, path = self.pending
+        world = self.world
+        body = self.ball.shape.body
+        ramp_end = world.ramp.end[0]
+        substep = STEP / world.substeps
+        deadline = time.perf_counter() + self.budget
+
+        # The space is stepped directly rather than through World.step,
+        # whose rules would bring the ball back when it goes off screen
+        while len(path) < PREVIEW_TICKS:
+            x, y = body.position
+            if x > 1024 or y < 0:
+                break
+            if time.perf_counter() > deadline:
+                return path
+            if x < ramp_end:
+                self.ball.fire(self.force)
+            for i in range(world.substeps):
+                world.space.step(substep)
+            path.append(tuple(body.position))
+
+        self.paths[key] = path
+        self.pending = None
+        return path
+
+class Shot:
+    """
+    A shot as the player would make it: the ramp is set to rampsize, then
+    after delay frames the mouse button is held for hold frames, pushing
+    the ball with force every frame
+    """
+
+    def __init__(self, rampsize=RAMPSIZE, force=FORCE/3, hold=30, delay=0):
+        """
+        Initialise the Shot
+        """
+        self.rampsize = rampsize
+        self.force = force
+        self.hold = hold
+        self.delay = delay
+
+    def __repr__(self):
+        return "Shot(rampsize={0}, force={1}, hold={2}, delay={3})".format(
+            self.rampsize, self.force, self.hold, self.delay)
+
+class Outcome:
+    """
+    The result of simulating a Shot
+    """
+
+    def __init__(self, shot, killed, snakes, frames, seconds, positions):
+        """
+        Initialise the Outcome
+        """
+        self.shot = shot
+        self.killed = killed
+        self.snakes = snakes
+        self.frames = frames
+        self.seconds = seconds
+        self.positions = positions
+
+    def won(self):
+        """
+        Returns whether every snake was killed
+        """
+        return self.killed == self.snakes
+
+    def game_time(self):
+        """
+        Returns the in game time the shot took, in seconds
+        """
+        return self.frames * STEP
+
+    def __repr__(self):
+        return "Outcome({0}, killed {1}/{2} in {3:.1f}s)".format(
+            self.shot, self.killed, self.snakes, self.game_time())
+
+def simulate(level, shot, max_time=30, world=None):
+    """
+    Builds a level and plays a shot on it headlessly, stepping until every
+    snake is dead or max_time seconds of game time have passed.
+    level is an index in LEVELS or a level's data, as load_level returns.
+    A world can be passed in to be reused between simulations, if it
+    already has the level it is put back to the start of it rather than
+    built again
+    """
+    started = time.perf_counter()
+    own_world = world is None
+    if own_world:
+        world = World()
+    if isinstance(level, dict):
+        if world.data is level and world.seed == 0:
+            world.retry()
+        else:
+            world.load(level)
+    elif world.level == level and world.seed == 0:
+        world.retry()
+    else:
+        world.build_level(level)
+    world.ramp.move(shot.rampsize)
+
+    max_frames = int(max_time / STEP)
+    fire_until = shot.delay + shot.hold
+    for frame in range(max_frames):
+        if shot.delay <= frame < fire_until:
+            world.fire(shot.force)
+        world.step()
+        if world.won():
+            break
+
+    outcome = Outcome(shot, world.snakes_killed(), len(world.snakes),
+                      world.frames, time.perf_counter() - started,
+                      world.body_positions())
+    if own_world:
+        world.close()
+    return outcome
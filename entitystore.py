@@ -0,0 +1,183 @@
+"""
+Array backed entity store for Angry Clones
+
+Keeps the position, angle and sprite of every crate and snake in NumPy
+arrays, read from the pymunk bodies in one pass per physics tick. Drawing
+then interpolates, culls and converts them to screen coordinates in a few
+vectorised operations instead of a Python call per entity per frame.
+The Crate and Snake objects stay as views onto their row of the store.
+
+Needs NumPy, the game falls back to drawing entity by entity without it
+"""
+
+import numpy
+import pygame
+
+# pymunk y runs up from the bottom, pygame's runs down from this height
+SCREEN_Y = 600
+
+class EntityStore:
+    """
+    Rows of positions, angles and sprite ids for a level's crates and
+    snakes. Sprites are images from an Assets registry, rotated in its
+    rotation steps
+    """
+
+    def __init__(self, assets, capacity=64):
+        """
+        Initialise the EntityStore with room for capacity entities, it
+        grows as needed
+        """
+        self.assets = assets
+        self.steps = assets.rotation_steps
+        self.files = []       # sprite id -> image filename
+        self.ids = {}         # image filename -> sprite id
+        self.surfaces = []    # sprite id -> surface for each rotation step
+        self.sizes = numpy.zeros((0, self.steps, 2), numpy.intp)
+        self.entities = []
+        self.bodies = []
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        """
+        Makes room for capacity entities, keeping the rows already filled
+        """
+        count = len(self.entities)
+        for name, shape, dtype in (("position", (capacity, 2), float),
+                                   ("previous", (capacity, 2), float),
+                                   ("angle", (capacity,), float),
+                                   ("previous_angle", (capacity,), float),
+                                   ("sprite", (capacity,), numpy.intp),
+                                   ("shown", (capacity,), bool)):
+            array = numpy.zeros(shape, dtype)
+            if count:
+                array[:count] = getattr(self, name)[:count]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def sprite_id(self, filename):
+        """
+        Returns the id of an image, giving it one if it's new
+        """
+        sprite = self.ids.get(filename)
+        if sprite is None:
+            sprite = len(self.files)
+            self.ids[filename] = sprite
+            self.files.append(filename)
+            self.surfaces.append([None] * self.steps)
+            self.sizes = numpy.concatenate(
+                (self.sizes, numpy.zeros((1, self.steps, 2), numpy.intp)))
+        return sprite
+
+    def clear(self):
+        """
+        Empties the store, detaching the entities from it
+        """
+        for entity in self.entities:
+            entity.store = None
+            entity.row = None
+        self.entities = []
+        self.bodies = []
+
+    def add(self, entity, filename):
+        """
+        Gives an entity a row, drawn with the image filename
+        """
+        row = len(self.entities)
+        if row == self.capacity:
+            self.allocate(self.capacity * 2)
+        self.entities.append(entity)
+        self.bodies.append(entity.shape.body)
+        self.sprite[row] = self.sprite_id(filename)
+        self.shown[row] = True
+        entity.store = self
+        entity.row = row
+
+    def set_sprite(self, row, filename):
+        """
+        Changes the image a row is drawn with
+        """
+        self.sprite[row] = self.sprite_id(filename)
+
+    def show(self, row, shown):
+        """
+        Shows or hides a row, hidden rows aren't drawn
+        """
+        self.shown[row] = shown
+
+    def read(self):
+        """
+        Reads every body's position and angle into the arrays
+        """
+        count = len(self.bodies)
+        if not count:
+            return
+        values = numpy.array([(body.position[0], body.position[1],
+                               body.angle) for body in self.bodies])
+        self.position[:count] = values[:, :2]
+        self.angle[:count] = values[:, 2]
+
+    def store_previous(self):
+        """
+        Keeps the positions and angles from before a physics step
+        """
+        count = len(self.bodies)
+        self.previous[:count] = self.position[:count]
+        self.previous_angle[:count] = self.angle[:count]
+
+    def reset_previous(self):
+        """
+        Reads the bodies and makes their previous positions the current
+        ones, for a freshly built level
+        """
+        self.read()
+        self.store_previous()
+
+    def sprites(self, alpha, view):
+        """
+        Returns (entity, surface, rect) for the shown entities whose
+        centres are in view, a pygame rect, alpha of the way between the
+        previous physics step and the current one
+        """
+        count = len(self.entities)
+        if not count:
+            return []
+        previous = self.previous[:count]
+        position = previous + (self.position[:count] - previous) * alpha
+        previous_angle = self.previous_angle[:count]
+        angle = previous_angle + (self.angle[:count] - previous_angle) * alpha
+
+        # The same conversion as to_pygame, truncating towards zero
+        centre = numpy.empty((count, 2), numpy.intp)
+        centre[:, 0] = position[:, 0]
+        centre[:, 1] = SCREEN_Y - position[:, 1]
+        rows = numpy.flatnonzero(self.shown[:count] &
+                                 (centre[:, 0] >= view.left) &
+                                 (centre[:, 0] < view.right) &
+                                 (centre[:, 1] >= view.top) &
+                                 (centre[:, 1] < view.bottom))
+        if not len(rows):
+            return []
+
+        # The same rounding as Assets.rotated
+        steps = numpy.rint(numpy.degrees(angle[rows]) * self.steps / 360.0)
+        steps = steps.astype(numpy.intp) % self.steps
+        sprites = self.sprite[rows]
+
+        surfaces = []
+        for sprite, step in zip(sprites.tolist(), steps.tolist()):
+            surface = self.surfaces[sprite][step]
+            if surface is None:
+                surface = self.assets.rotation(self.files[sprite], step)
+                self.surfaces[sprite][step] = surface
+                self.sizes[sprite, step] = surface.get_size()
+            surfaces.append(surface)
+
+        sizes = self.sizes[sprites, steps]
+        topleft = centre[rows] - sizes // 2
+        Rect = pygame.Rect
+        rects = [Rect(x, y, width, height) for x, y, width, height in
+                 numpy.hstack((topleft, sizes)).tolist()]
+        entities = self.entities
+        return [(entities[row], surface, rect) for row, surface, rect in
+                zip(rows.tolist(), surfaces, rects)]
@@ -0,0 +1,177 @@
+"""
+Frame export for Angry Clones
+
+Writes rendered frames out as a video stream or as images. Each frame is
+blitted into one of a pool of 24 bit RGB surfaces, the only copy of its
+pixels that is made, and background threads write them straight from the
+surface's buffer, so drawing the next frame never waits on the disk, a
+pipe or PNG encoding unless the writers have used up the whole pool.
+
+The output is either a name with {0} in it, for a numbered PNG per frame
+(NAME{0:05d}.png pads the number), or a file to write raw RGB frames to.
+That can be a named pipe into an encoder, stdout isn't used as pygame
+and pymunk print to it when they are imported. For example, with bash
+and ffmpeg:
+  python angryclones.py --replay FILE --export >(ffmpeg -f rawvideo \
+      -pix_fmt rgb24 -s 1024x652 -r 60 -i - out.mp4)
+"""
+
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import pygame
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Masks of a 24 bit surface whose bytes are in R, G, B order
+RGB_MASKS = (0xff, 0xff00, 0xff0000, 0)
+
+def png_chunk(kind, body):
+    """
+    Returns a PNG chunk: its length, kind, body and CRC
+    """
+    return (struct.pack(">I", len(body)) + kind + body +
+            struct.pack(">I", zlib.crc32(kind + body)))
+
+def rows(data, size, pitch):
+    """
+    Returns the rows of raw RGB pixels of the given size, pitch bytes
+    apart in data, as memoryviews
+    """
+    width, height = size
+    view = memoryview(data)
+    return [view[offset:offset + width * 3]
+            for offset in range(0, pitch * height, pitch)]
+
+def png(data, size, pitch=None, level=1):
+    """
+    Returns raw RGB pixels of the given size, rows pitch bytes apart or
+    packed by default, encoded as a PNG, compressed at zlib level.
+    pygame.image.save can do this too, but it takes and lets go of the GIL
+    over and over as it writes, so while the frames are being drawn it
+    spends most of its time waiting for it. zlib lets go of it once for
+    the whole compression
+    """
+    width, height = size
+    # Every row starts with its filter type, 0 for none
+    filtered = b"".join(b"\0" + row
+                        for row in rows(data, size, pitch or width * 3))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (PNG_SIGNATURE + png_chunk(b"IHDR", header) +
+            png_chunk(b"IDAT", zlib.compress(filtered, level)) +
+            png_chunk(b"IEND", b""))
+
+class FrameWriter:
+    """
+    Writes frames of one size to an output on background threads. A raw
+    stream has one thread, to keep the frames in order, numbered PNGs get
+    one per CPU. Frames are copied into a pool of queued surfaces, plus
+    one for each thread to be writing, and write() blocks while every one
+    of them is waiting to be written
+    """
+
+    def __init__(self, output, size, queued=16, threads=None):
+        """
+        Initialise the FrameWriter and start its threads
+        """
+        self.output = output
+        self.size = size
+        self.images = "{" in output
+        self.stream = None if self.images else open(output, "wb")
+        if not self.images:
+            threads = 1
+        elif threads is None:
+            threads = os.cpu_count() or 1
+        self.queue = queue.Queue()
+        self.free = queue.Queue()
+        for frame in range(queued + threads):
+            self.free.put(pygame.Surface(size, 0, 24, RGB_MASKS))
+        self.error = None
+        self.frames = 0
+        self.bytes = 0
+        self.waited = 0.0   # seconds write() spent waiting for a surface
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run, daemon=True)
+                        for thread in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, surface):
+        """
+        Copies surface into a free surface of the pool and queues it as
+        the next frame. Raises the error a thread stopped on, if one has
+        stopped
+        """
+        if self.error is not None:
+            raise self.error
+        started = time.perf_counter()
+        frame = self.free.get()
+        self.waited += time.perf_counter() - started
+        frame.blit(surface, (0, 0))
+        self.queue.put((self.frames, frame))
+        self.frames += 1
+
+    def run(self):
+        """
+        Writes queued frames until close() queues None, run by each thread,
+        then hands their surfaces back to the pool. Any error is reported
+        and kept for write() or close() to raise, then the rest of the
+        frames are handed back unwritten, so neither of them blocks forever
+        """
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            number, surface = frame
+            if self.error is None:
+                self.write_frame(number, surface)
+            self.free.put(surface)
+
+    def write_frame(self, number, surface):
+        """
+        Writes a frame from its surface's pixels, without copying them
+        unless its rows are padded. Any error is reported and kept
+        """
+        try:
+            pitch = surface.get_pitch()
+            # The buffer keeps the surface locked until this returns
+            data = memoryview(surface.get_buffer())
+            if self.images:
+                data = png(data, self.size, pitch)
+                with open(self.output.format(number), "wb") as image:
+                    image.write(data)
+            else:
+                if pitch != self.size[0] * 3:
+                    data = b"".join(rows(data, self.size, pitch))
+                self.stream.write(data)
+            with self.lock:
+                self.bytes += len(data)
+        except Exception as error:
+            # Only the first error is reported and raised
+            with self.lock:
+                if self.error is None:
+                    print("Frame {0} could not be written: {1}".format(
+                        number, error), file=sys.stderr)
+                    self.error = error
+
+    def close(self):
+        """
+        Waits for every queued frame to be written, then closes the output.
+        Raises the error a thread stopped on, if there was one
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except OSError as error:
+                self.error = self.error or error
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,338 @@
+"""
+Procedural level generator for Angry Clones
+
+Builds random levels out of the same towers the hand made levels use:
+crate pillars, TNT on top of pairs of pillars and stacks of TNT, with
+snakes on top. Each candidate is dropped into a headless space to settle
+and thrown away if anything in it falls or a snake dies on its own, then
+shots are tried on it until one kills every snake. Levels are made on a
+process pool and streamed out as they are accepted.
+
+Levels are saved as levelN.json files the game can load with --levels.
+The same seed always gives the same level.
+
+Usage: python generator.py DIRECTORY [--count N] [--workers N] [--seed N]
+                                     [--preset P]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import engine
+
+# Sizes of the pieces, with a pixel between stacked ones so nothing starts
+# overlapping. Crates are 46 wide, TNT 92 and snakes 80
+CRATE_PITCH = 47
+TNT_PITCH   = 93
+SNAKE_LIFT  = 41     # from the top of what a snake stands on to its centre
+ARCH_SPAN   = 100    # between the pillars under a TNT crate
+LEAN        = 12     # most a crate is set off from the one under it
+
+# Towers stand between these, clear of the ramp, with gaps between them
+FIRST_X   = 300
+LAST_X    = 980
+TOWER_GAP = (10, 60)
+
+# Candidates get SETTLE_TICKS to fall into place, then everything has to
+# stay within DRIFT pixels and TILT radians for CHECK_TICKS
+SETTLE_TICKS = 60
+CHECK_TICKS  = 60
+DRIFT        = 2.0
+TILT         = 0.05
+
+# Shots tried on a level, the most likely to win first
+SHOTS = list(itertools.product((engine.FORCE/3, engine.FORCE/2,
+                                engine.FORCE/6),
+                               (15, 30, 5),
+                               range(100, 601, 50)))
+MAX_TIME = 10    # seconds of game time a shot gets
+
+# Seeds given to a worker at a time, and jobs kept queued per worker
+CHUNK_SIZE = 8
+QUEUED     = 2
+
+# Each tower is built with its left edge at x, and returns its crates,
+# TNT, width and the middle of its top
+
+def arch(rng, x, ground):
+    """
+    Two crate pillars with a TNT crate across them
+    """
+    height = rng.randint(2, 4)
+    crates = [[x + 23 + side, ground + 24 + CRATE_PITCH * i]
+              for side in (0, ARCH_SPAN) for i in range(height)]
+    middle = x + 23 + ARCH_SPAN // 2
+    top = ground + CRATE_PITCH * height
+    return crates, [[middle, top + 47]], ARCH_SPAN + 46, (middle,
+                                                         top + TNT_PITCH)
+
+def stack(rng, x, ground):
+    """
+    A stack of TNT crates
+    """
+    height = rng.randint(1, 3)
+    tnt = [[x + 46, ground + 47 + TNT_PITCH * i] for i in range(height)]
+    return [], tnt, 92, (x + 46, ground + TNT_PITCH * height)
+
+def pillar(rng, x, ground):
+    """
+    A single pillar of crates, each set off a little from the one under
+    it, so tall ones can lean too far and fall
+    """
+    height = rng.randint(2, 5)
+    slack = LEAN * (height - 1)
+    middle = x + 23 + slack
+    crates = []
+    for i in range(height):
+        crates.append([middle, ground + 24 + CRATE_PITCH * i])
+        middle += rng.randint(-LEAN, LEAN)
+    return crates, [], 46 + slack * 2, (crates[-1][0],
+                                        ground + CRATE_PITCH * height)
+
+TOWERS = (arch, stack, pillar)
+
+def draw_map(crates, tnt, snakes, ground):
+    """
+    Returns the level drawn in ASCII like the hand made levels' maps, a
+    character is 25 pixels across and a crate high
+    """
+    cells = {}
+    def cell(x, y):
+        return (int(round((y - ground) / float(CRATE_PITCH) - 0.5)),
+                int(round((x - FIRST_X) / 25.0)))
+    for x, y in crates:
+        cells[cell(x, y)] = "#"
+    for x, y in tnt:
+        row, column = cell(x, y)
+        for dx, top, bottom in ((-1, "#", "#"), (0, "T", "#"),
+                                (1, "#", "#")):
+            cells[(row + 1, column + dx)] = top
+            cells[(row, column + dx)] = bottom
+    for x, y in snakes:
+        cells[cell(x, y - SNAKE_LIFT + CRATE_PITCH / 2.0)] = "S"
+    rows = max(row for row, column in cells) + 1
+    columns = max(column for row, column in cells) + 1
+    return ["".join(cells.get((row, column), " ")
+                    for column in range(columns)).rstrip()
+            for row in reversed(range(rows))]
+
+def generate(seed, ground=engine.GROUND):
+    """
+    Returns a random level, as load_level would, built from towers left to
+    right with snakes on top of some of them, at least one
+    """
+    rng = random.Random(seed)
+    crates, tnt, tops, snakes = [], [], [], []
+    x = FIRST_X + rng.randint(0, 100)
+    while True:
+        tower = rng.choice(TOWERS)
+        tower_crates, tower_tnt, width, top = tower(rng, x, ground)
+        if x + width > LAST_X:
+            break
+        crates += tower_crates
+        tnt += tower_tnt
+        tops.append(top)
+        x += width + rng.randint(*TOWER_GAP)
+    for middle, top in tops:
+        if rng.random() < 0.6:
+            snakes.append([middle, top + SNAKE_LIFT])
+    if not snakes:
+        middle, top = rng.choice(tops)
+        snakes.append([middle, top + SNAKE_LIFT])
+
+    return {
+        "name": "Generated {0}".format(seed),
+        "seed": seed,
+        "timer": 30,
+        "ground": ground,
+        "width": engine.GROUND_WIDTH,
+        "map": draw_map(crates, tnt, snakes, ground),
+        "crates": crates,
+        "tnt": tnt,
+        "snakes": snakes,
+        "broken": [],
+    }
+
+def standing(world):
+    """
+    Steps the world for CHECK_TICKS and returns whether every crate and
+    snake stayed where it was, upright, with no snake dead and no TNT gone
+    off
+    """
+    before = world.body_positions()
+    for tick in range(CHECK_TICKS):
+        world.step()
+    if world.snakes_killed() or world.exploded():
+        return False
+    for (kind, x, y, angle), (old_kind, old_x, old_y, old_angle) in zip(
+            world.body_positions(), before):
+        if kind != "ball" and (abs(x - old_x) > DRIFT or
+                               abs(y - old_y) > DRIFT or abs(angle) > TILT):
+            return False
+    return True
+
+def settle(world, data):
+    """
+    Drops a level's pieces into place and returns the level with them
+    where they came to rest, or None if anything fell over, went off or a
+    snake died. The settled level is loaded and checked again, so it
+    stands from its first tick
+    """
+    world.load(data)
+    for tick in range(SETTLE_TICKS):
+        world.step()
+    if not standing(world):
+        return None
+
+    positions = [[round(x, 1), round(y, 1)]
+                 for kind, x, y, angle in world.body_positions()
+                 if kind != "ball"]
+    crates = len(data["crates"])
+    settled = dict(data, crates=positions[:crates],
+                   tnt=positions[crates:len(world.crates)],
+                   snakes=positions[len(world.crates):])
+    world.load(settled)
+    if not standing(world):
+        return None
+    return settled
+
+def solve(world, data, max_time=MAX_TIME):
+    """
+    Tries shots on a level until one kills every snake, returns the shot
+    and how many were tried, or None and how many were tried
+    """
+    for tried, (force, hold, rampsize) in enumerate(SHOTS, 1):
+        shot = engine.Shot(rampsize, force, hold)
+        if engine.simulate(data, shot, max_time, world).won():
+            return shot, tried
+    return None, len(SHOTS)
+
+# Each worker process keeps one World and reuses it, until it is given
+# another preset
+_world = None
+
+def _generate_chunk(args):
+    """
+    Generates, settles and solves the levels of a chunk of seeds in a
+    worker process. Returns the accepted levels and counts of the
+    candidates rejected as unstable and as unsolvable
+    """
+    global _world
+    seeds, max_time, preset = args
+    if _world is None or _world.preset.settings() != preset.settings():
+        if _world is not None:
+            _world.close()
+        _world = engine.World(preset=preset)
+
+    levels = []
+    unstable = unsolvable = 0
+    for seed in seeds:
+        data = settle(_world, generate(seed))
+        if data is None:
+            unstable += 1
+            continue
+        shot, tried = solve(_world, data, max_time)
+        if shot is None:
+            unsolvable += 1
+            continue
+        data["solution"] = [shot.rampsize, shot.force, shot.hold, shot.delay]
+        data["shots_tried"] = tried
+        levels.append(data)
+    return levels, unstable, unsolvable
+
+class Generator:
+    """
+    Generates levels on a process pool, keeping a few chunks of seeds
+    queued per worker so none of them waits for work
+    """
+
+    def __init__(self, workers=None, seed=0, max_time=MAX_TIME,
+                 chunk_size=CHUNK_SIZE, preset=None):
+        """
+        Initialise the Generator, seeds are used in order from seed.
+        Levels are settled and solved with the physics of preset,
+        balanced by default
+        """
+        self.preset = preset or engine.PRESETS[engine.DEFAULT_PRESET]
+        self.workers = workers or os.cpu_count() or 1
+        self.seed = seed
+        self.max_time = max_time
+        self.chunk_size = chunk_size
+        self.candidates = 0
+        self.unstable = 0
+        self.unsolvable = 0
+
+    def levels(self, count):
+        """
+        Yields count accepted levels as the workers make them, the order
+        depends on which worker finishes first
+        """
+        accepted = 0
+        with ProcessPoolExecutor(self.workers) as pool:
+            pending = set()
+            while accepted < count:
+                while len(pending) < self.workers * QUEUED:
+                    seeds = range(self.seed, self.seed + self.chunk_size)
+                    self.seed += self.chunk_size
+                    pending.add(pool.submit(_generate_chunk,
+                                            (seeds, self.max_time,
+                                             self.preset)))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    levels, unstable, unsolvable = future.result()
+                    self.candidates += self.chunk_size
+                    self.unstable += unstable
+                    self.unsolvable += unsolvable
+                    for data in levels:
+                        if accepted < count:
+                            accepted += 1
+                            yield data
+            for future in pending:
+                future.cancel()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("directory",
+                        help="where to save the levels, as levelN.json")
+    parser.add_argument("--count", type=int, default=100,
+                        help="levels to make")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first candidate")
+    parser.add_argument("--max-time", type=float, default=MAX_TIME,
+                        help="seconds of game time each shot gets")
+    parser.add_argument("--preset", default=engine.DEFAULT_PRESET,
+                        help="physics preset, or a JSON file of settings")
+    args = parser.parse_args(argv)
+    try:
+        preset = engine.find_preset(args.preset)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+
+    generator = Generator(args.workers, args.seed, args.max_time,
+                          preset=preset)
+    started = time.perf_counter()
+    for number, data in enumerate(generator.levels(args.count), 1):
+        path = os.path.join(args.directory, "level{0}.json".format(number))
+        with open(path, "w") as level_file:
+            json.dump(data, level_file, indent=4)
+    seconds = time.perf_counter() - started
+
+    print("{0} levels from {1} candidates ({2} unstable, {3} unsolvable) "
+          "in {4:.1f}s, {5:.0f} levels/minute on {6} workers".format(
+              args.count, generator.candidates, generator.unstable,
+              generator.unsolvable, seconds, args.count * 60 / seconds,
+              generator.workers))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
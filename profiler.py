@@ -0,0 +1,162 @@
+"""
+Frame time instrumentation for Angry Clones
+
+Times named sections of each frame and keeps rolling percentiles of them,
+along with per frame counts such as bodies, shapes and blits. Doesn't
+depend on pygame, so headless runs can use it too
+"""
+
+import csv
+import json
+import time
+from collections import OrderedDict, deque
+
+class _Section:
+    """
+    Times one named section, used through Profiler.section
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, time.perf_counter() - self.started)
+        return False
+
+class _NoSection:
+    """
+    Stands in for _Section while the profiler is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_no_section = _NoSection()
+
+def percentile(values, fraction):
+    """
+    Returns the value fraction of the way through the sorted values
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+class Profiler:
+    """
+    Collects section timings and counts frame by frame.
+    The last window frames are kept for percentiles, and with record set
+    every frame is kept for export
+    """
+
+    def __init__(self, enabled=False, window=300, record=False):
+        """
+        Initialise the Profiler
+        """
+        self.enabled = enabled
+        self.record = record
+        self.window = window
+        self.timings = OrderedDict()   # section -> deque of seconds
+        self.counts = OrderedDict()    # name -> deque of values
+        self.frame = OrderedDict()     # this frame's timings and counts
+        self.frames = []               # every frame, when recording
+        self.frame_started = None
+
+    def section(self, name):
+        """
+        Returns a context manager timing a named section of the frame
+        """
+        if not self.enabled:
+            return _no_section
+        return _Section(self, name)
+
+    def add(self, name, seconds):
+        """
+        Adds time to a named section of this frame
+        """
+        self.frame[name] = self.frame.get(name, 0.0) + seconds
+
+    def count(self, name, value):
+        """
+        Records a count for this frame, such as the number of bodies
+        """
+        if self.enabled:
+            self.frame["#" + name] = value
+
+    def end_frame(self):
+        """
+        Finishes the frame, timing it as a whole as the 'frame' section
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_started is not None:
+            self.frame["frame"] = now - self.frame_started
+        self.frame_started = now
+
+        for name, value in self.frame.items():
+            if name.startswith("#"):
+                values = self.counts.setdefault(name[1:],
+                                                deque(maxlen=self.window))
+            else:
+                values = self.timings.setdefault(name,
+                                                 deque(maxlen=self.window))
+            values.append(value)
+        if self.record and self.frame:
+            self.frames.append(self.frame)
+        self.frame = OrderedDict()
+
+    def percentiles(self, name):
+        """
+        Returns the p50, p95 and p99 of a section in milliseconds
+        """
+        values = self.timings.get(name, ())
+        return tuple(percentile(values, fraction) * 1000
+                     for fraction in (0.5, 0.95, 0.99))
+
+    def report(self):
+        """
+        Returns a line per section with its percentiles, then the latest
+        value of each count
+        """
+        lines = []
+        for name in self.timings:
+            lines.append("{0:<10} p50 {1:6.2f}  p95 {2:6.2f}  p99 {3:6.2f} ms"
+                         .format(name, *self.percentiles(name)))
+        for name, values in self.counts.items():
+            lines.append("{0:<10} {1}".format(name, values[-1]))
+        return lines
+
+    def export(self, path):
+        """
+        Writes every recorded frame to a .csv or .json file
+        """
+        if path.endswith(".json"):
+            with open(path, "w") as export_file:
+                json.dump({"frames": self.frames,
+                           "percentiles": dict(
+                               (name, self.percentiles(name))
+                               for name in self.timings)},
+                          export_file, indent=1)
+            return
+
+        columns = []
+        for frame in self.frames:
+            for name in frame:
+                if name not in columns:
+                    columns.append(name)
+        with open(path, "w", newline="") as export_file:
+            writer = csv.writer(export_file)
+            writer.writerow([name.lstrip("#") for name in columns])
+            for frame in self.frames:
+                writer.writerow([frame.get(name, "") for name in columns])
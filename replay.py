@@ -0,0 +1,253 @@
+"""
+Replay recording and playback for Angry Clones
+
+A recording is everything needed to play a level again exactly as it was
+played: the level, the physics substeps, the seed of the World's random
+and the inputs of every tick (ramp height, firing, loading a ball and its
+kind), along with
+a checksum of the state the level ended in. Playing one back through the
+headless engine has to end in the same state, bit for bit. A checksum of
+the level's data is kept too, so a recording played with a different set
+of levels is turned away rather than ending in the wrong state.
+
+Files are a short header then each recording, 3 bytes per tick.
+
+Usage: python replay.py FILE [--repeat N]
+"""
+
+import argparse
+import json
+import struct
+import sys
+import time
+import zlib
+
+import engine
+
+MAGIC   = b"ACRP"
+VERSION = 4
+
+HEADER    = struct.Struct("<4sB")     # magic, version
+# level, level checksum, substeps, seed, ticks, checksum
+RECORDING = struct.Struct("<HIBIII")
+TICK      = struct.Struct("<hB")      # rampsize, flags
+
+# Tick flags, the kind of ball loaded is in the bits from KIND_SHIFT up
+FIRE  = 1
+RESET = 2
+KIND_SHIFT = 2
+
+def level_checksum(data):
+    """
+    Returns a CRC of a level's data, as returned by engine.load_level
+    """
+    return zlib.crc32(json.dumps(data, sort_keys=True).encode("utf-8"))
+
+def checksum(world):
+    """
+    Returns a CRC of the physics state of every ball, crate and snake,
+    and of which crates are broken, which TNT has gone off and which
+    snakes are dead
+    """
+    crc = 0
+    for entity in world.balls + world.crates + world.snakes:
+        body = entity.shape.body
+        crc = zlib.crc32(struct.pack("<6d", body.position[0],
+                                     body.position[1], body.velocity[0],
+                                     body.velocity[1], body.angle,
+                                     body.angular_velocity), crc)
+    flags = [crate.broken is not None for crate in world.crates]
+    flags += [crate.exploded for crate in world.crates if crate.is_tnt]
+    flags += [snake.already_killed_snake for snake in world.snakes]
+    return zlib.crc32(bytes(flags), crc)
+
+class Recording:
+    """
+    The inputs of one attempt at a level
+    """
+
+    def __init__(self, level, seed, substeps=engine.SUBSTEPS, ticks=None,
+                 checksum=None, level_crc=None):
+        """
+        Initialise the Recording, of the level with the given index in
+        engine.LEVELS unless level_crc says otherwise
+        """
+        self.level = level
+        if level_crc is None:
+            level_crc = level_checksum(engine.LEVELS[level])
+        self.level_crc = level_crc
+        self.seed = seed
+        self.substeps = substeps
+        self.ticks = ticks if ticks is not None else []
+        self.checksum = checksum
+
+    def add(self, rampsize, fire, reset, kind=0):
+        """
+        Records one tick's inputs
+        """
+        self.ticks.append((int(rampsize),
+                           (FIRE if fire else 0) | (RESET if reset else 0) |
+                           kind << KIND_SHIFT))
+
+    def check_level(self):
+        """
+        Raises ValueError unless the recording's level is the same in
+        engine.LEVELS as when it was recorded
+        """
+        if (self.level >= len(engine.LEVELS) or
+                level_checksum(engine.LEVELS[self.level]) != self.level_crc):
+            raise ValueError("{0}: wrong level set, level {1} isn't the "
+                             "one it was recorded on".format(
+                                 self, self.level + 1))
+
+    def play(self, world, on_tick=None):
+        """
+        Plays the recording on a World, which must have been built with
+        the recording's level, seed and substeps. on_tick is called after
+        every tick. Returns the checksum of the final state
+        """
+        for rampsize, flags in self.ticks:
+            world.tick(rampsize, flags & FIRE, flags & RESET,
+                       kind=flags >> KIND_SHIFT)
+            if on_tick is not None:
+                on_tick(world)
+        return checksum(world)
+
+    def __repr__(self):
+        return "Recording(level {0}, seed {1}, {2} ticks)".format(
+            self.level + 1, self.seed, len(self.ticks))
+
+class Recorder:
+    """
+    Records the attempts made on levels as the game is played
+    """
+
+    def __init__(self):
+        """
+        Initialise the Recorder
+        """
+        self.recordings = []
+        self.current = None
+        self.world = None
+
+    def start(self, world, level, seed):
+        """
+        Starts recording an attempt on a level the world has just built
+        """
+        self.finish()
+        self.current = Recording(level, seed, world.substeps,
+                                 level_crc=level_checksum(world.data))
+        self.world = world
+
+    def tick(self, rampsize, fire, reset, kind=0):
+        """
+        Records one tick's inputs, if an attempt is being recorded
+        """
+        if self.current is not None:
+            self.current.add(rampsize, fire, reset, kind)
+
+    def finish(self):
+        """
+        Ends the attempt being recorded, noting the state it ended in
+        """
+        if self.current is not None:
+            self.current.checksum = checksum(self.world)
+            self.recordings.append(self.current)
+            self.current = None
+
+    def save(self, path):
+        """
+        Ends any attempt being recorded and writes every recording to path
+        """
+        self.finish()
+        save(path, self.recordings)
+
+def save(path, recordings):
+    """
+    Writes recordings to a file
+    """
+    with open(path, "wb") as replay_file:
+        replay_file.write(HEADER.pack(MAGIC, VERSION))
+        for recording in recordings:
+            replay_file.write(RECORDING.pack(
+                recording.level, recording.level_crc, recording.substeps,
+                recording.seed, len(recording.ticks), recording.checksum))
+            replay_file.write(b"".join(TICK.pack(*tick)
+                                       for tick in recording.ticks))
+
+def load(path):
+    """
+    Reads the recordings from a file, raising ValueError if any is of
+    a different set of levels from engine.LEVELS
+    """
+    with open(path, "rb") as replay_file:
+        data = replay_file.read()
+
+    magic, version = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{0}: not a version {1} replay".format(path,
+                                                                VERSION))
+    offset = HEADER.size
+    recordings = []
+    while offset < len(data):
+        (level, level_crc, substeps, seed, count,
+         crc) = RECORDING.unpack_from(data, offset)
+        offset += RECORDING.size
+        end = offset + count * TICK.size
+        ticks = list(TICK.iter_unpack(data[offset:end]))
+        offset = end
+        recording = Recording(level, seed, substeps, ticks, crc, level_crc)
+        recording.check_level()
+        recordings.append(recording)
+    return recordings
+
+def play(recording, world=None):
+    """
+    Plays a recording headlessly as fast as possible, returns the World
+    and the checksum it ended with. A world can be passed in to be
+    reused, its substeps are set to the recording's. If it already has
+    the recording's level and seed loaded it is only put back to the
+    start of the level. Raises ValueError if the recording is of a
+    different set of levels
+    """
+    recording.check_level()
+    if world is None:
+        world = engine.World()
+    world.substeps = recording.substeps
+    if (world.level, world.seed) == (recording.level, recording.seed):
+        world.retry()
+    else:
+        world.build_level(recording.level, recording.seed)
+    return world, recording.play(world)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("file")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="times to play each recording, for timing")
+    args = parser.parse_args(argv)
+
+    try:
+        recordings = load(args.file)
+    except ValueError as error:
+        parser.error(str(error))
+
+    matched = True
+    for recording in recordings:
+        started = time.perf_counter()
+        for repeat in range(args.repeat):
+            world, crc = play(recording)
+        seconds = (time.perf_counter() - started) / args.repeat
+        ok = crc == recording.checksum
+        matched = matched and ok
+        print("{0}: {1}/{2} snakes dead, checksum {3:08x} {4}, "
+              "{5:.0f} ticks/s".format(
+                  recording, world.snakes_killed(), len(world.snakes), crc,
+                  "matches" if ok else "MISMATCH, recorded {0:08x}".format(
+                      recording.checksum),
+                  len(recording.ticks) / seconds if seconds else 0))
+
+    return 0 if matched else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,184 @@
+"""
+Shot search solver for Angry Clones
+
+Sweeps ramp height x force x timing for a level with the headless engine,
+spread over a process pool, and refines around the shots that kill every
+snake.
+
+Usage: python solver.py [--level N] [--workers N] [--rounds N] [--preset P]
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+
+# Coarse search grid, refined around winning shots afterwards
+RAMPSIZES = range(100, 601, 50)
+FORCES    = (engine.FORCE/6, engine.FORCE/3, engine.FORCE/2)
+HOLDS     = (5, 15, 30, 60)
+DELAYS    = (0, 15, 45)   # frames before the button is pressed
+
+# Each worker process keeps one World and reuses its space, until it is
+# given another preset
+_world = None
+
+def _simulate_chunk(args):
+    """
+    Runs a chunk of shots in a worker process, returning a list of
+    (rampsize, force, hold, delay, killed, snakes, frames)
+    """
+    global _world
+    level, shots, max_time, preset = args
+    if _world is None or _world.preset.settings() != preset.settings():
+        if _world is not None:
+            _world.close()
+        _world = engine.World(preset=preset)
+
+    results = []
+    for rampsize, force, hold, delay in shots:
+        shot = engine.Shot(rampsize, force, hold, delay)
+        outcome = engine.simulate(level, shot, max_time, _world)
+        results.append((rampsize, force, hold, delay, outcome.killed,
+                        outcome.snakes, outcome.frames))
+    return results
+
+def chunks(items, size):
+    """
+    Splits a list into lists of at most size items
+    """
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+class Solver:
+    """
+    Searches a level for shots that kill every snake within the timer
+    """
+
+    def __init__(self, level, workers=None, max_time=None, chunk_size=8,
+                 preset=None):
+        """
+        Initialise the Solver, max_time defaults to the level's timer,
+        or 30 seconds for untimed levels. Shots are simulated with the
+        physics of preset, balanced by default
+        """
+        self.level = level
+        self.preset = preset or engine.PRESETS[engine.DEFAULT_PRESET]
+        self.workers = workers or os.cpu_count() or 1
+        self.max_time = max_time or engine.LEVELS[level]["timer"] or 30
+        self.chunk_size = chunk_size
+        self.simulations = 0
+        self.seconds = 0.0
+        self.win_rate = 0.0
+
+    def run(self, shots, pool):
+        """
+        Simulates every shot on the pool, returns the results
+        """
+        started = time.perf_counter()
+        jobs = [(self.level, chunk, self.max_time, self.preset)
+                for chunk in chunks(list(shots), self.chunk_size)]
+        results = []
+        for chunk in pool.map(_simulate_chunk, jobs):
+            results.extend(chunk)
+        self.simulations += sum(len(job[1]) for job in jobs)
+        self.seconds += time.perf_counter() - started
+        return results
+
+    def refine(self, wins):
+        """
+        Returns a finer grid of shots around the winning ones
+        """
+        shots = set()
+        for rampsize, force, hold, delay, killed, snakes, frames in wins:
+            for dr, df, dh, dd in itertools.product((-20, -10, 0, 10, 20),
+                                                    (0.9, 1.0, 1.1),
+                                                    (-4, 0, 4),
+                                                    (-5, 0, 5)):
+                shots.add((rampsize + dr, force * df, max(1, hold + dh),
+                           max(0, delay + dd)))
+        return sorted(shots)
+
+    def solve(self, rounds=2, grid=None):
+        """
+        Runs a coarse sweep then rounds of refinement around the winning
+        shots. Returns the winning results, quickest first
+        """
+        if grid is None:
+            grid = list(itertools.product(RAMPSIZES, FORCES, HOLDS, DELAYS))
+
+        wins = []
+        with ProcessPoolExecutor(self.workers) as pool:
+            shots = grid
+            for round_number in range(rounds + 1):
+                round_wins = [result for result in self.run(shots, pool)
+                              if result[4] == result[5]]
+                wins.extend(round_wins)
+                if round_number == 0:
+                    self.win_rate = len(round_wins) / float(len(grid))
+                if not round_wins:
+                    break
+                # Refine around the quickest wins of this round
+                round_wins.sort(key=lambda result: result[6])
+                shots = self.refine(round_wins[:20])
+
+        wins.sort(key=lambda result: result[6])
+        return wins
+
+    def throughput(self):
+        """
+        Returns simulations per second per core
+        """
+        if not self.seconds:
+            return 0.0
+        return self.simulations / self.seconds / self.workers
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--level", type=int, default=None,
+                        help="index of the level to solve, 0 is the first."
+                             " All levels by default")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--rounds", type=int, default=2,
+                        help="rounds of refinement after the coarse sweep")
+    parser.add_argument("--preset", default=engine.DEFAULT_PRESET,
+                        help="physics preset, or a JSON file of settings")
+    args = parser.parse_args(argv)
+    try:
+        preset = engine.find_preset(args.preset)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.level is None:
+        levels = range(len(engine.LEVELS))
+    else:
+        levels = [args.level]
+
+    all_winnable = True
+    for level in levels:
+        solver = Solver(level, args.workers, preset=preset)
+        wins = solver.solve(args.rounds)
+        print("Level {0}: {1} winning shots out of {2} simulations, "
+              "{3:.0f} sims/s/core on {4} workers"
+              .format(level + 1, len(wins), solver.simulations,
+                      solver.throughput(), solver.workers))
+        if wins:
+            rampsize, force, hold, delay, killed, snakes, frames = wins[0]
+            print("  quickest: rampsize {0}, force {1:.0f}, hold {2}, "
+                  "delay {3}, all {4} snakes dead in {5:.1f}s"
+                  .format(rampsize, force, hold, delay, snakes,
+                          frames * engine.STEP))
+            # Fewer winning shots on the coarse grid means a harder level
+            print("  difficulty: {0:.1%} of coarse shots win"
+                  .format(solver.win_rate))
+        else:
+            all_winnable = False
+            print("  not winnable within {0}s".format(solver.max_time))
+
+    return 0 if all_winnable else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))